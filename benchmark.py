@@ -0,0 +1,207 @@
+"""Benchmarks of the spreadsheet engine on synthetic workbooks.
+
+Every benchmark builds its workbook first (not timed), then times one
+operation a few times and keeps the fastest run. The peak memory of the
+operation is measured in a separate run under tracemalloc, since tracing
+slows everything down. Results are written as JSON so that runs on
+different commits can be compared:
+
+    python benchmark.py --output before.json
+    git checkout my-branch
+    python benchmark.py --output after.json --compare before.json
+"""
+
+# Import packages
+from typing import *
+import argparse
+import json
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+from classes import *
+
+
+# Columns of the synthetic sheets, every fifth column holds formulas
+COLUMNS = 10
+
+
+def dense_workbook_data(cells: int) -> dict:
+    """A single sheet in the dense JSON format with about this many cells."""
+    rows = max(cells // COLUMNS, 1)
+    sheet_data = []
+    for row in range(rows):
+        row_data = []
+        for column in range(COLUMNS):
+            if column % 5 == 4:
+                text = f"={column_index_to_letter(column - 1)}{row + 1} * 2"
+                row_data.append([None, text])
+            else:
+                value = float(row * COLUMNS + column)
+                row_data.append([value, format_number(value)])
+        sheet_data.append(row_data)
+    return {"Sheet1": sheet_data}
+
+
+def loaded_workbook(cells: int) -> Workbook:
+    workbook = Workbook()
+    workbook.load_from_json(dense_workbook_data(cells))
+    workbook.recalculate()
+    return workbook
+
+
+def chain_sheet(cells: int) -> Worksheet:
+    """A1 holds a number and every cell below it adds one to the cell above."""
+    worksheet = Worksheet(rows=1, columns=1)
+    worksheet.set_range(0, 0, [[1]] + [[f"=A{row} + 1"] for row in range(1, cells)])
+    return worksheet
+
+
+def fanout_sheet(cells: int) -> Worksheet:
+    """A1 holds a number and every cell of column B depends on it directly."""
+    worksheet = Worksheet(rows=1, columns=2)
+    worksheet.set_cell_value(0, 0, 1)
+    worksheet.set_range(0, 1, [[f"=A1 * {row}"] for row in range(cells)])
+    return worksheet
+
+
+def range_sheet(cells: int) -> Worksheet:
+    """A column of numbers and a few formulas aggregating all of it."""
+    worksheet = Worksheet(rows=1, columns=2)
+    worksheet.set_range(0, 0, [[row] for row in range(cells)])
+    last = f"A{cells}"
+    worksheet.set_range(0, 1, [[f"=SUM(A1:{last})"], [f"=AVERAGE(A1:{last})"], [f"=MAX(A1:{last})"],
+                               [f"=COUNT(A1:{last})"]])
+    return worksheet
+
+
+# Setups build a workbook and return the operation to time
+
+
+def edit_first_cell(worksheet: Worksheet) -> Callable[[], Any]:
+    """Edits A1 with a new number every run, so every run recalculates."""
+    cell = worksheet.get_cell(0, 0)
+    counter = iter(range(2, sys.maxsize))
+    return lambda: cell.insert_text(str(next(counter)))
+
+
+def setup_load_from_json(cells: int) -> Callable[[], Any]:
+    data = dense_workbook_data(cells)
+    return lambda: Workbook().load_from_json(data)
+
+
+def setup_to_json(cells: int) -> Callable[[], Any]:
+    return loaded_workbook(cells).to_json
+
+
+def setup_edit_chain(cells: int) -> Callable[[], Any]:
+    return edit_first_cell(chain_sheet(cells))
+
+
+def setup_edit_fanout(cells: int) -> Callable[[], Any]:
+    return edit_first_cell(fanout_sheet(cells))
+
+
+def setup_edit_ranges(cells: int) -> Callable[[], Any]:
+    return edit_first_cell(range_sheet(cells))
+
+
+def setup_calculate_on_range(cells: int) -> Callable[[], Any]:
+    worksheet = range_sheet(cells)
+    return lambda: calculate_on_range(worksheet, [f"A1:A{cells}"], "sum")
+
+
+# name: (description, setup)
+BENCHMARKS: Dict[str, Tuple[str, Callable[[int], Callable[[], Any]]]] = {
+    "load_from_json": ("Workbook.load_from_json of a dense sheet", setup_load_from_json),
+    "to_json": ("Workbook.to_json of a dense sheet", setup_to_json),
+    "edit_chain": ("Cell.insert_text at the head of a chain of formulas", setup_edit_chain),
+    "edit_fanout": ("Cell.insert_text on a cell every formula depends on", setup_edit_fanout),
+    "edit_ranges": ("Cell.insert_text in a column aggregated by range formulas", setup_edit_ranges),
+    "calculate_on_range": ("calculate_on_range SUM over a column", setup_calculate_on_range),
+}
+
+
+def run_benchmark(setup: Callable[[int], Callable[[], Any]], cells: int, repeat: int) -> dict:
+    operation = setup(cells)
+    runs = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        operation()
+        runs.append(time.perf_counter() - started)
+
+    tracemalloc.start()
+    operation()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {"seconds": min(runs), "runs": runs, "peak_bytes": peak}
+
+
+def current_commit() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> List[str]:
+    """Prints the change of every benchmark against a baseline, returns the regressed ones."""
+    regressions = []
+    if baseline.get("cells") != results["cells"]:
+        print(f"Warning: the baseline was run with {baseline.get('cells')} cells, this run with {results['cells']}")
+    print(f"\nCompared with {baseline.get('commit') or 'the baseline'}:")
+    for name, result in results["benchmarks"].items():
+        before = baseline.get("benchmarks", {}).get(name)
+        if before is None:
+            continue
+        ratio = result["seconds"] / before["seconds"] if before["seconds"] else float('inf')
+        memory_ratio = result["peak_bytes"] / before["peak_bytes"] if before["peak_bytes"] else float('inf')
+        flag = ""
+        if ratio > threshold:
+            flag = "  REGRESSION"
+            regressions.append(name)
+        print(f"  {name:<20} time x{ratio:6.2f}   peak memory x{memory_ratio:6.2f}{flag}")
+    return regressions
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Benchmarks of the spreadsheet engine on synthetic workbooks.")
+    parser.add_argument("--cells", type=int, default=100_000, help="size of the synthetic sheets (default 100000)")
+    parser.add_argument("--repeat", type=int, default=3, help="timed runs of every benchmark (default 3)")
+    parser.add_argument("--only", nargs="+", choices=sorted(BENCHMARKS), help="run only these benchmarks")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="compare with the results of an earlier run (a JSON file)")
+    parser.add_argument("--threshold", type=float, default=1.25,
+                        help="slowdown ratio reported as a regression by --compare (default 1.25)")
+    arguments = parser.parse_args()
+
+    results = {
+        "commit": current_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cells": arguments.cells,
+        "repeat": arguments.repeat,
+        "benchmarks": {},
+    }
+    for name in arguments.only or BENCHMARKS:
+        description, setup = BENCHMARKS[name]
+        result = run_benchmark(setup, arguments.cells, arguments.repeat)
+        results["benchmarks"][name] = result
+        print(f"{name:<20} {result['seconds'] * 1000:10.2f} ms  peak {result['peak_bytes'] / 2 ** 20:8.2f} MiB"
+              f"  {description}")
+
+    if arguments.output:
+        with open(arguments.output, 'w') as file:
+            json.dump(results, file, indent=2)
+    if arguments.compare:
+        with open(arguments.compare) as file:
+            baseline = json.load(file)
+        if compare(results, baseline, arguments.threshold):
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -3,20 +3,352 @@ implementation of the spreadsheets: Cell, Worksheet, Workbook"""
 
 # Import packages
 from typing import *
-import re
 import math
-import statistics
 import json
+import mmap
+import os
+import struct
+import sys
+import threading
+from time import perf_counter
+from array import array
+from bisect import bisect_left, bisect_right, insort
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from collections.abc import MutableMapping
+from functools import lru_cache, partial
+from itertools import accumulate, filterfalse
+from formulas import (AGGREGATES, BINARY_OPERATORS, Formula, RangeArgument, compile_formula, lookup_key,
+                      match_position, number_batches, split_reference)
 
 
 def is_float(string: str):
     try:
         float(string)
         return True
-    except ValueError:
+    except (TypeError, ValueError):
         return False
 
 
+def format_number(value: float) -> str:
+    """Values like 5.0 are written as "5", other values as str(value)"""
+    if value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+def to_text(value: Any) -> Optional[str]:
+    """The text to write in a cell for a value given as a string or a number"""
+    if value is None or isinstance(value, str):
+        return value
+    return format_number(float(value))
+
+
+class CircularReferenceError(ValueError):
+    """
+    Raised when a recalculation finds cells whose formulas depend (directly or
+    through other cells) on themselves.
+    """
+    def __init__(self, cells: List['Cell']) -> None:
+        self.cells = cells
+        names = ", ".join(cell.get_name() for cell in cells)
+        super().__init__(f"Circular reference detected in the cells: {names}")
+
+
+# Format tag written in the first line of workbook files in the sparse row format
+SPARSE_FORMAT = "sparse-rows"
+
+
+# Column storage
+
+# Numbers of a column are kept in chunks of this many rows
+CHUNK_SIZE = 1024
+
+
+class Column:
+    """
+    Storage of a single worksheet column. Numeric values are kept in typed
+    array('d') chunks where NaN marks a row without a number, so a column of
+    plain numbers costs 8 bytes per row. Chunks of a sheet opened from a binary
+    workbook file are memoryviews of the mapped file instead. Text is kept in a side table, and only
+    when it is not just the written form of the number (e.g. "5" for 5.0).
+    Values that are not numbers (e.g. text returned by a formula) are kept in
+    another side table. A lookup index (see ColumnIndex) is built the first
+    time a lookup function searches the column, and updated on every write.
+    """
+    __slots__ = ('chunks', 'texts', 'objects', 'index')
+
+    def __init__(self) -> None:
+        self.chunks: Dict[int, Union[array, memoryview]] = {}
+        self.texts: Dict[int, Optional[str]] = {}
+        self.objects: Dict[int, Any] = {}
+        self.index: Optional[ColumnIndex] = None
+
+    def get_value(self, row: int) -> Any:
+        if self.objects and row in self.objects:
+            return self.objects[row]
+        chunk = self.chunks.get(row // CHUNK_SIZE)
+        if chunk is None:
+            return None
+        number = chunk[row % CHUNK_SIZE]
+        # NaN marks an empty row
+        return number if number == number else None
+
+    def get_text(self, row: int) -> Optional[str]:
+        if row in self.texts:
+            return self.texts[row]
+        number = self.get_value(row)
+        if number is None:
+            return None
+        return format_number(number)
+
+    def set(self, row: int, value: Any, text: Optional[str]) -> None:
+        if self.index is not None:
+            old_key = self.lookup_key(row)
+        self.objects.pop(row, None)
+        if isinstance(value, (int, float)):
+            number = float(value)
+        else:
+            number = math.nan
+            if value is not None:
+                self.objects[row] = value
+
+        chunk = self.chunks.get(row // CHUNK_SIZE)
+        if chunk is None and number == number:
+            chunk = array('d', [math.nan]) * CHUNK_SIZE
+            self.chunks[row // CHUNK_SIZE] = chunk
+        if chunk is not None:
+            chunk[row % CHUNK_SIZE] = number
+
+        if number == number and text is not None and text == format_number(number):
+            # the text can be rebuilt from the number
+            self.texts.pop(row, None)
+        elif value is None and text is None:
+            self.texts.pop(row, None)
+        else:
+            self.texts[row] = text
+
+        if self.index is not None:
+            self.index.update(row, old_key, self.lookup_key(row))
+
+    def set_value(self, row: int, value: Any) -> None:
+        self.set(row, value, self.get_text(row))
+
+    def set_text(self, row: int, text: Optional[str]) -> None:
+        self.set(row, self.get_value(row), text)
+
+    def number_batches(self, first_row: int, last_row: int) -> Iterator[array]:
+        """
+        Yields the numbers stored between the two rows (inclusive), one array
+        per chunk, with the empty rows filtered out.
+        """
+        first_chunk, last_chunk = first_row // CHUNK_SIZE, last_row // CHUNK_SIZE
+        indices = range(first_chunk, last_chunk + 1)
+        if len(indices) > len(self.chunks):
+            indices = sorted(index for index in self.chunks if first_chunk <= index <= last_chunk)
+        for index in indices:
+            chunk = self.chunks.get(index)
+            if chunk is None:
+                continue
+            start = max(first_row - index * CHUNK_SIZE, 0)
+            stop = min(last_row - index * CHUNK_SIZE + 1, CHUNK_SIZE)
+            if start > 0 or stop < CHUNK_SIZE:
+                chunk = chunk[start:stop]
+            yield array('d', filterfalse(math.isnan, chunk))
+
+    def rows(self) -> List[int]:
+        """Returns the sorted rows that hold a value or a text."""
+        rows = set(self.texts)
+        rows.update(self.objects)
+        for index, chunk in self.chunks.items():
+            start = index * CHUNK_SIZE
+            rows.update(start + offset for offset, number in enumerate(chunk) if number == number)
+        return sorted(rows)
+
+    def lookup_value(self, row: int) -> Any:
+        """The value of a row, or its text if it holds text that is not a formula."""
+        value = self.get_value(row)
+        if value is None:
+            text = self.texts.get(row)
+            if text is not None and not text.startswith('='):
+                return text
+        return value
+
+    def lookup_key(self, row: int) -> Any:
+        return lookup_key(self.lookup_value(row))
+
+    def lookup_index(self) -> 'ColumnIndex':
+        if self.index is None:
+            self.index = ColumnIndex(self)
+        return self.index
+
+    def __getstate__(self) -> tuple:
+        # chunks still mapped from a binary file are copied, a memoryview
+        # cannot be pickled
+        chunks = {}
+        for index, chunk in self.chunks.items():
+            if not isinstance(chunk, array):
+                chunk = array('d', chunk)
+            chunks[index] = chunk
+        return chunks, self.texts, self.objects
+
+    def __setstate__(self, state: tuple) -> None:
+        self.chunks, self.texts, self.objects = state
+        self.index = None
+
+
+class ColumnIndex:
+    """
+    Lookup index of a column, used by VLOOKUP, MATCH and COUNTIF. The hash part
+    maps every lookup key to the sorted rows holding it, the sorted part keeps
+    the (key, row) pairs of the numbers and of the texts in order. Each part is
+    built the first time a lookup needs it, then kept up to date by
+    Column.set, so a lookup costs a dictionary access or a binary search.
+    The sorted part is kept for the whole column: an approximate match or a
+    count over part of the column also steps over the keys of rows outside
+    the range, and falls back to reading the rows of the range once that
+    would cost more, so it never costs more than the size of the range.
+    """
+    __slots__ = ('column', 'rows_by_key', 'sorted_keys')
+
+    def __init__(self, column: Column) -> None:
+        self.column = column
+        self.rows_by_key: Optional[Dict[Any, List[int]]] = None
+        # (numbers, texts)
+        self.sorted_keys: Optional[Tuple[List[tuple], List[tuple]]] = None
+
+    def keys(self) -> Iterator[Tuple[int, Any]]:
+        """Yields the (row, key) of the rows holding something, in order."""
+        for row in self.column.rows():
+            key = self.column.lookup_key(row)
+            if key is not None:
+                yield row, key
+
+    def get_rows_by_key(self) -> Dict[Any, List[int]]:
+        if self.rows_by_key is None:
+            rows_by_key = {}
+            for row, key in self.keys():
+                rows_by_key.setdefault(key, []).append(row)
+            self.rows_by_key = rows_by_key
+        return self.rows_by_key
+
+    def get_sorted_keys(self, key: Any) -> List[tuple]:
+        """The sorted (key, row) pairs of the keys of the same kind as the key."""
+        if self.sorted_keys is None:
+            numbers, texts = [], []
+            for row, row_key in self.keys():
+                (texts if isinstance(row_key, str) else numbers).append((row_key, row))
+            numbers.sort()
+            texts.sort()
+            self.sorted_keys = (numbers, texts)
+        return self.sorted_keys[isinstance(key, str)]
+
+    def update(self, row: int, old_key: Any, new_key: Any) -> None:
+        if old_key == new_key:
+            return
+        if self.rows_by_key is not None:
+            if old_key is not None:
+                rows = self.rows_by_key[old_key]
+                del rows[bisect_left(rows, row)]
+                if not rows:
+                    del self.rows_by_key[old_key]
+            if new_key is not None:
+                insort(self.rows_by_key.setdefault(new_key, []), row)
+        if self.sorted_keys is not None:
+            if old_key is not None:
+                entries = self.sorted_keys[isinstance(old_key, str)]
+                del entries[bisect_left(entries, (old_key, row))]
+            if new_key is not None:
+                insort(self.sorted_keys[isinstance(new_key, str)], (new_key, row))
+
+    def find(self, key: Any, match_type: int, first_row: int, last_row: int) -> Optional[int]:
+        """
+        The row between first_row and last_row whose key is equal to the key
+        (match_type 0, the first such row), the largest key not above it (1)
+        or the smallest key not below it (-1).
+        """
+        if match_type == 0:
+            rows = self.get_rows_by_key().get(key, ())
+            position = bisect_left(rows, first_row)
+            if position < len(rows) and rows[position] <= last_row:
+                return rows[position]
+            return None
+        entries = self.get_sorted_keys(key)
+        steps = last_row - first_row + 1
+        if match_type > 0:
+            position = bisect_right(entries, (key, math.inf))
+            stop = max(position - steps, 0)
+            for index in range(position - 1, stop - 1, -1):
+                if first_row <= entries[index][1] <= last_row:
+                    return entries[index][1]
+            if stop == 0:
+                return None
+        else:
+            position = bisect_left(entries, (key, -math.inf))
+            stop = min(position + steps, len(entries))
+            for index in range(position, stop):
+                if first_row <= entries[index][1] <= last_row:
+                    return entries[index][1]
+            if stop == len(entries):
+                return None
+        return self.scan(key, match_type, first_row, last_row)
+
+    def scan(self, key: Any, match_type: int, first_row: int, last_row: int) -> Optional[int]:
+        """find for match types 1 and -1 by reading the rows of the range."""
+        is_text = isinstance(key, str)
+        best = None
+        for row in range(first_row, last_row + 1):
+            row_key = self.column.lookup_key(row)
+            if row_key is None or isinstance(row_key, str) != is_text:
+                continue
+            if match_type > 0:
+                if row_key <= key and (best is None or (row_key, row) > best):
+                    best = (row_key, row)
+            elif row_key >= key and (best is None or (row_key, row) < best):
+                best = (row_key, row)
+        return None if best is None else best[1]
+
+    def count(self, operator_text: str, key: Any, first_row: int, last_row: int, whole_column: bool) -> int:
+        """
+        The number of rows between first_row and last_row whose key compares
+        to the key with the operator. With whole_column the rows outside the
+        bounds are known to be empty and the count is read off the index.
+        """
+        if operator_text in ('=', '<>'):
+            rows = self.get_rows_by_key().get(key, ())
+            equal = len(rows) if whole_column else bisect_right(rows, last_row) - bisect_left(rows, first_row)
+            # empty rows are not equal to anything either
+            return equal if operator_text == '=' else last_row - first_row + 1 - equal
+        entries = self.get_sorted_keys(key)
+        if operator_text == '<':
+            start, stop = 0, bisect_left(entries, (key, -math.inf))
+        elif operator_text == '<=':
+            start, stop = 0, bisect_right(entries, (key, math.inf))
+        elif operator_text == '>':
+            start, stop = bisect_right(entries, (key, math.inf)), len(entries)
+        else:
+            start, stop = bisect_left(entries, (key, -math.inf)), len(entries)
+        if whole_column:
+            return stop - start
+        if stop - start > last_row - first_row + 1:
+            # fewer rows in the range than keys to check
+            compare = BINARY_OPERATORS[operator_text]
+            is_text = isinstance(key, str)
+            return sum(1 for row_key in map(self.column.lookup_key, range(first_row, last_row + 1))
+                       if row_key is not None and isinstance(row_key, str) == is_text and compare(row_key, key))
+        return sum(1 for position in range(start, stop) if first_row <= entries[position][1] <= last_row)
+
+
+class RecalculationCancelled(Exception):
+    """
+    Raised when a recalculation is cancelled. `remaining` lists the dirty cells
+    that were not evaluated yet, so a later recalculation can resume from them.
+    """
+    def __init__(self, remaining: List['Cell']) -> None:
+        self.remaining = remaining
+        super().__init__(f"Recalculation cancelled with {len(remaining)} cell(s) left")
+
+
 # Cell class
 class Cell:
     """
@@ -24,63 +356,227 @@ class Cell:
     individual data, text or formulas (to use formula - the user must write
     the equals sign "=" at the beginning of writing in the cell). cells are
     referenced by their column letter and row number (e.g. A1, B10).
+
+    A Cell is a lightweight view of a position in its worksheet: the value and
+    text live in the worksheet columns and the dependency lists are kept by the
+    worksheet only for cells that take part in formulas. Views are created when
+    needed, and two views of the same position are equal.
     """
-    def __init__(self, worksheet, value=None, text=None) -> None:
-        self.value: Optional[float] = value
-        self.text: Optional[str] = text
-        # Implementing the observer design pattern to manage dependencies
-        # between cells. This allows a cell to notify other dependent cells
-        # (subscribers) to update themselves when its value changes.
-        self.subscribers: List[Cell] = []
-        self.subscriptions: List[Cell] = []
+    __slots__ = ('owner_worksheet', 'row', 'column')
+
+    def __init__(self, worksheet, row: int = 0, column: int = 0) -> None:
         self.owner_worksheet = worksheet
+        # Position of the cell in its worksheet
+        self.row = row
+        self.column = column
+
+    def __eq__(self, other: object) -> bool:
+        return (isinstance(other, Cell) and self.owner_worksheet is other.owner_worksheet
+                and self.row == other.row and self.column == other.column)
+
+    def __hash__(self) -> int:
+        return hash((self.row, self.column))
+
+    def __repr__(self) -> str:
+        return f"Cell({self.get_name()})"
+
+    @property
+    def value(self) -> Optional[float]:
+        column = self.owner_worksheet.columns.get(self.column)
+        return None if column is None else column.get_value(self.row)
+
+    @value.setter
+    def value(self, value: Optional[float]) -> None:
+        self.owner_worksheet.column_storage(self.column).set_value(self.row, value)
+
+    @property
+    def text(self) -> Optional[str]:
+        column = self.owner_worksheet.columns.get(self.column)
+        return None if column is None else column.get_text(self.row)
+
+    @text.setter
+    def text(self, text: Optional[str]) -> None:
+        self.owner_worksheet.column_storage(self.column).set_text(self.row, text)
+
+    # Implementing the observer design pattern to manage dependencies
+    # between cells. This allows a cell to notify other dependent cells
+    # (subscribers) to update themselves when its value changes.
+
+    @property
+    def subscribers(self) -> Collection['Cell']:
+        """
+        The cells depending on this cell, as an insertion-ordered set.
+        """
+        return self.owner_worksheet.subscribers.get((self.row, self.column), ())
+
+    @property
+    def subscriptions(self) -> Sequence[Union['Cell', 'CellRange']]:
+        """
+        The cells and ranges this cell's formula references, in the order of
+        formula.references.
+        """
+        return self.owner_worksheet.subscriptions.get((self.row, self.column), ())
+
+    @subscriptions.setter
+    def subscriptions(self, cells: List[Union['Cell', 'CellRange']]) -> None:
+        if cells:
+            self.owner_worksheet.subscriptions[(self.row, self.column)] = cells
+        else:
+            self.owner_worksheet.subscriptions.pop((self.row, self.column), None)
+
+    @property
+    def formula(self) -> Optional[Formula]:
+        """
+        Compiled form of the formula in text, None for plain values.
+        """
+        return self.owner_worksheet.formulas.get((self.row, self.column))
+
+    @formula.setter
+    def formula(self, formula: Optional[Formula]) -> None:
+        if formula is not None:
+            self.owner_worksheet.formulas[(self.row, self.column)] = formula
+        else:
+            self.owner_worksheet.formulas.pop((self.row, self.column), None)
+
+    def get_dependents(self) -> List['Cell']:
+        """
+        Returns the cells depending on this cell: its subscribers and the cells
+        whose formulas use a range containing it.
+        """
+        dependents = list(self.subscribers)
+        buckets = self.owner_worksheet.range_subscribers.get(self.column)
+        if buckets:
+            row = self.row
+            dependents.extend(cell for cell_range, cell in buckets.get(row // CHUNK_SIZE, ())
+                              if cell_range.first_row <= row <= cell_range.last_row)
+        return dependents
 
     def subscribe(self, cell: 'Cell') -> None:
         """
         Adds a new cell to the list of subscribers that will be notified when this cell's value changes.
         """
-        if cell not in self.subscribers:
-            self.subscribers.append(cell)
+        self.owner_worksheet.subscribers.setdefault((self.row, self.column), {})[cell] = None
 
     def unsubscribe(self, cell: 'Cell') -> None:
-        if cell in self.subscribers:
-            self.subscribers = [subscriber_cell for subscriber_cell in self.subscribers if subscriber_cell != cell]
+        subscribers = self.owner_worksheet.subscribers.get((self.row, self.column))
+        if subscribers and cell in subscribers:
+            del subscribers[cell]
+            if not subscribers:
+                del self.owner_worksheet.subscribers[(self.row, self.column)]
 
     def set(self, value: float, text: str) -> None:
-        self.value = value
-        self.text = text
+        self.owner_worksheet.column_storage(self.column).set(self.row, value, text)
 
-    def insert_text(self, text: str) -> None:
+    def insert_text(self, text: str, recalculate: bool = True) -> List['Cell']:
+        """
+        Sets the text of the cell and recalculates the cell and everything that
+        depends on it. Returns the recalculated cells in evaluation order.
+        Inside a batch (see RecalcEngine.batch) the formula is linked and the
+        recalculation done when the batch commits, and nothing is returned.
+        With recalculate=False the formula is linked but recalculating the cell
+        and its dependents is left to the caller (e.g. a RecalcJob).
+        """
+        engine = self.owner_worksheet.engine
+        if engine.journal is not None:
+            engine.journal.record(self.owner_worksheet, self.row, self.column, self.text, text)
+        if engine.batch_depth:
+            self.set(float(text) if is_float(text) else None, text)
+            engine.pending[self] = None
+            return []
+
+        if engine.journal is not None:
+            engine.journal.close()
         self.text = text
+        try:
+            self.link_formula()
+        except ValueError:
+            # the formula is invalid, its dependents must not keep the old value
+            self.value = None
+            if recalculate:
+                self.notify_subscribers()
+            raise
 
-        # unsubscribe from all my subscriptions
-        for subscription in self.subscriptions:
-            subscription.unsubscribe(self)
+        if self.formula is None:
+            self.value = float(text) if is_float(text) else None
+        if not recalculate:
+            return []
+        return engine.recalculate([self])
+
+    def link_formula(self) -> None:
+        """
+        Compiles the formula held in the cell text (if any) once and caches it
+        on the cell, then subscribes this cell to every cell the formula
+        references, on its own sheet or on other sheets of the workbook.
+        Recalculations reuse the cached formula.
+        """
+        self.unlink_formula()
+
+        if not (self.text and self.text.startswith('=')):
+            return
+        formula = compile_formula(self.text)
+        engine = self.owner_worksheet.engine
+        if engine.profile is not None:
+            engine.profile.compilations += 1
+        subscriptions = []
+        for reference in formula.references:
+            sheet_name, name = split_reference(reference)
+            try:
+                worksheet = engine.resolve_sheet(sheet_name, self) if sheet_name else self.owner_worksheet
+                if ':' in name:
+                    # A range is a single subscription covering all of its cells
+                    subscription = worksheet.get_range(name)
+                    worksheet.subscribe_range(subscription, self)
+                else:
+                    row, column = parse_cell_name(name)
+                    if not worksheet.is_valid_position(row, column):
+                        raise ValueError(f"Cell {reference} does not exist in the worksheet.")
+                    subscription = Cell(worksheet, row=row, column=column)
+                    subscription.subscribe(self)
+            except ValueError:
+                self.__unsubscribe_all(subscriptions)
+                raise
+            subscriptions.append(subscription)
+        # The subscriptions are kept in the order of formula.references, which
+        # is the order the formula expects the referenced values in
+        self.subscriptions = subscriptions
+        self.formula = formula
+
+    def unlink_formula(self) -> None:
+        """
+        Drops the compiled formula of the cell and its subscriptions. The text
+        and value of the cell are kept.
+        """
+        engine = self.owner_worksheet.engine
+        if engine.unresolved:
+            engine.forget_unresolved(self)
+        self.__unsubscribe_all(self.subscriptions)
         self.subscriptions = []
+        self.formula = None
 
-        if text and text.startswith('='):
-            self.value = self.__calculate_expression()
-            cell_names = re.findall(r'[A-Za-z]+\d+', self.text) # TODO: fix it to work also for A10
-            for cell_name in cell_names:
-                cell = self.owner_worksheet.get_cell_by_reference(cell_name)
-                if cell not in self.subscriptions:
-                    cell.subscribe(self)
-                    self.subscriptions.append(cell)
-        elif is_float(text):
-            self.value = float(text)
-        else:
-            self.value = None
-        self.notify_subscribers()
+    def __unsubscribe_all(self, subscriptions: Sequence[Union['Cell', 'CellRange']]) -> None:
+        for subscription in subscriptions:
+            if isinstance(subscription, CellRange):
+                subscription.worksheet.unsubscribe_range(subscription, self)
+            else:
+                subscription.unsubscribe(self)
+
+    def get_name(self) -> str:
+        """
+        Returns the reference name of the cell (e.g. 'A1').
+        """
+        return f"{column_index_to_letter(self.column)}{self.row + 1}"
 
     def get_display_value(self):
-        if self.value is not None:
-            if self.value.is_integer():
+        value = self.value
+        if value is not None:
+            if isinstance(value, float):
                 # values like "5.0" display as "5"
-                return str(int(self.value))
+                return format_number(value)
             else:
-                return str(self.value)
-        elif self.text is not None:
-            return self.text
+                return str(value)
+        text = self.text
+        if text is not None:
+            return text
         else:
             return ""
 
@@ -91,50 +587,672 @@ class Cell:
         return self.value
 
     def __calculate_expression(self) -> float:
-        # Find all cell names in the expression
-        if self.text is None:
+        if self.formula is None:
             return None
-        expression = self.text[1:]
-        cell_names = re.findall(r'[A-Za-z]+\d+', expression) # fix it to work also for A10
-        modified_expression = expression
-        
-        # Replace cell names with their current values from the worksheet
-        for cell_name in cell_names:
-            if self.owner_worksheet.cell_exists(cell_name):
-                cell = self.owner_worksheet.get_cell_by_reference(cell_name)
-                cell.subscribe(self)
-                cell_value = cell.get_value()
-                # Use 0 if the cell is empty
-                if cell_value is None:
-                    cell_value = 0
-                modified_expression = modified_expression.replace(cell_name, str(cell_value))
-            else:
-                raise ValueError(f"Cell {cell_name} does not exist in the worksheet.")
 
-        # Prepare the safe environment with necessary math functions
-        custom_functions = {"sqrt": math.sqrt, "pow": math.pow}  # Add more functions as needed
+        # Fetch the current values of the referenced cells, None if a cell is
+        # empty. Ranges are passed as they are, the functions read them in batches
+        values = []
+        for subscription in self.subscriptions:
+            if isinstance(subscription, CellRange):
+                values.append(subscription)
+                continue
+            values.append(subscription.get_value())
 
-        # Evaluate the expression
+        # Evaluate the cached formula
         try:
-            result = eval(modified_expression, custom_functions)
+            result = self.formula.evaluate(values)
         except Exception as e:
-            raise ValueError(f"Failed to evaluate expression '{modified_expression}'. Error: {str(e)}")
-
-        # Set the result in the target cell and trigger updates to subscribers
+            raise ValueError(f"Failed to evaluate expression '{self.formula.expression}'. Error: {str(e)}")
+        if isinstance(result, (bool, int)):
+            result = float(result)
         return result
 
-    def notify_subscribers(self) -> None:
+    def notify_subscribers(self) -> List['Cell']:
         """
-        Notifies all subscribed cells to update based on the new value of this cell.
+        Notifies all subscribed cells (and the cells depending on them) to update
+        based on the new value of this cell.
         """
-        for subscriber in self.subscribers:
-            subscriber.update()
+        return self.owner_worksheet.engine.recalculate(self.get_dependents())
 
     def update(self):
         value = self.__calculate_expression()
         self.value = value
 
 
+class RecalcEngine:
+    """
+    Propagates changes through the dependency graph of the cells.
+    The transitive dependents of the changed cells are marked dirty and each
+    dirty cell is evaluated exactly once, in topological order, so a chain
+    A1->B1->C1 is fully updated and a diamond-shaped dependency is not
+    recalculated once per path.
+    """
+
+    def __init__(self) -> None:
+        # Held while the dependency graph is walked or changed, so a
+        # recalculation can run on a worker thread (see RecalcJob)
+        self.lock = threading.RLock()
+        # Cells written while a batch is open, linked and recalculated together
+        # when the outermost batch commits
+        self.batch_depth = 0
+        self.pending: Dict[Cell, None] = {}
+        self.batch_recalculated: List[Cell] = []
+        # The sheets of the workbook by name (set by the Workbook), to resolve
+        # references to other sheets such as Sheet2!A1. Cells referencing a
+        # sheet that does not exist are kept by sheet name, and linked again
+        # when a sheet with that name appears
+        self.sheets: Optional[Mapping[str, 'Worksheet']] = None
+        self.unresolved: Dict[str, Dict[Cell, None]] = {}
+        # Set while profiling (see Workbook.start_profiling)
+        self.profile: Optional[RecalcProfile] = None
+        # Undo/redo history of the edits, see Journal
+        self.journal: Optional[Journal] = None
+
+    def resolve_sheet(self, sheet_name: str, cell: Cell) -> 'Worksheet':
+        """
+        Returns the sheet named in a reference of the formula of the cell.
+        Raises ValueError if there is no such sheet, and remembers the cell
+        until there is.
+        """
+        if self.sheets is not None and sheet_name in self.sheets:
+            return self.sheets[sheet_name]
+        self.unresolved.setdefault(sheet_name, {})[cell] = None
+        raise ValueError(f"Sheet '{sheet_name}' does not exist.")
+
+    def forget_unresolved(self, cell: Cell) -> None:
+        for sheet_name in list(self.unresolved):
+            cells = self.unresolved[sheet_name]
+            cells.pop(cell, None)
+            if not cells:
+                del self.unresolved[sheet_name]
+
+    def forget_unresolved_sheet(self, worksheet: 'Worksheet') -> None:
+        """Forgets the cells of a worksheet waiting for sheets, e.g. when it is removed."""
+        for sheet_name in list(self.unresolved):
+            cells = {cell: None for cell in self.unresolved[sheet_name] if cell.owner_worksheet is not worksheet}
+            if cells:
+                self.unresolved[sheet_name] = cells
+            else:
+                del self.unresolved[sheet_name]
+
+    @contextmanager
+    def batch(self) -> Iterator[List[Cell]]:
+        """
+        Defers formula linking and recalculation of the cells written inside
+        the block until it exits, then runs a single ordered recalculation.
+        Yields the list that receives the recalculated cells on commit.
+        Batches can be nested, the outermost one commits.
+        """
+        if self.batch_depth == 0:
+            self.batch_recalculated = []
+        recalculated = self.batch_recalculated
+        self.batch_depth += 1
+        try:
+            yield recalculated
+        finally:
+            self.batch_depth -= 1
+            if self.batch_depth == 0:
+                self.commit()
+
+    def commit(self) -> List[Cell]:
+        """
+        Links the formulas of the cells written in the batch and recalculates
+        them and their dependents in one pass.
+        """
+        if self.journal is not None:
+            self.journal.close()
+        cells = list(self.pending)
+        self.pending = {}
+        errors = []
+        for cell in cells:
+            try:
+                cell.link_formula()
+            except ValueError as e:
+                cell.value = None
+                errors.append(e)
+        order = self.recalculate(cells)
+        self.batch_recalculated.extend(order)
+        if errors:
+            raise errors[0]
+        return order
+
+    def recalculate(self, changed: Iterable[Cell]) -> List[Cell]:
+        """
+        Recalculates the changed cells (if they hold formulas) and all the cells
+        depending on them. Returns the recalculated cells in evaluation order.
+        Raises CircularReferenceError if some of the cells depend on themselves,
+        after recalculating all the cells that are not part of the cycle.
+        """
+        with self.lock:
+            return self.evaluate(self.mark_dirty(changed))
+
+    def evaluate(self, dirty: Dict[Cell, List[Cell]], cancelled: Optional[threading.Event] = None) -> List[Cell]:
+        """
+        Evaluates the dirty cells (as returned by mark_dirty) in topological
+        order. If the cancelled event is set the evaluation stops before the
+        next cell and RecalculationCancelled is raised.
+        """
+        # Count for every dirty cell how many of its dirty precedents must be
+        # evaluated before it
+        pending = dict.fromkeys(dirty, 0)
+        for dependents in dirty.values():
+            for dependent in dependents:
+                pending[dependent] += 1
+
+        ready = [cell for cell in dirty if pending[cell] == 0]
+        order = []
+        errors = []
+        profile = self.profile
+        if profile is not None:
+            profile.begin(dirty)
+        while ready:
+            if cancelled is not None and cancelled.is_set():
+                if profile is not None:
+                    profile.end()
+                evaluated = set(order)
+                raise RecalculationCancelled([cell for cell in dirty if cell not in evaluated])
+            cell = ready.pop()
+            try:
+                if profile is not None:
+                    profile.update(cell, dirty[cell])
+                elif cell.formula is not None:
+                    cell.update()
+            except ValueError as e:
+                cell.value = None
+                errors.append(e)
+            order.append(cell)
+            for dependent in dirty[cell]:
+                pending[dependent] -= 1
+                if pending[dependent] == 0:
+                    ready.append(dependent)
+        if profile is not None:
+            profile.end()
+
+        if len(order) < len(dirty):
+            # The cells left are part of a cycle or depend on one
+            cycle = [cell for cell in dirty if pending[cell] > 0]
+            for cell in cycle:
+                cell.value = None
+            raise CircularReferenceError(cycle)
+        if errors:
+            raise errors[0]
+        return order
+
+    def mark_dirty(self, changed: Iterable[Cell]) -> Dict[Cell, List[Cell]]:
+        """
+        Returns the changed cells together with all the cells that depend on
+        them, directly or indirectly, each cell once, mapped to their direct
+        dependents.
+        """
+        dirty = {}
+        queue = list(dict.fromkeys(changed))
+        while queue:
+            cell = queue.pop()
+            if cell in dirty:
+                continue
+            dependents = cell.get_dependents()
+            dirty[cell] = dependents
+            queue.extend(dependent for dependent in dependents if dependent not in dirty)
+        return dirty
+
+
+class CellProfile:
+    """Measurements of a single cell, see RecalcProfile."""
+    __slots__ = ('evaluations', 'total_time', 'max_time', 'depth')
+
+    def __init__(self) -> None:
+        self.evaluations = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        # Longest chain of formulas (seen in a recalculation) leading to the cell
+        self.depth = 0
+
+
+class RecalcProfile:
+    """
+    Measurements collected by the engine while profiling: per cell, how many
+    times its formula was evaluated, for how long, and its dependency depth;
+    overall counters; and the slowest chains of dependent cells, i.e. the
+    chains of evaluations that took the most time in a recalculation.
+    """
+
+    # Number of the slowest chains kept
+    CHAINS_KEPT = 10
+
+    def __init__(self, sheets: Optional[Mapping[str, 'Worksheet']] = None) -> None:
+        self.sheets = sheets
+        self.cells: Dict[Cell, CellProfile] = {}
+        self.recalculations = 0
+        self.evaluations = 0
+        self.compilations = 0
+        # Dependency edges followed to find the dirty cells
+        self.fanout = 0
+        self.total_time = 0.0
+        # (time, cells) of the slowest chains, slowest first
+        self.slowest_chains: List[Tuple[float, List[Cell]]] = []
+        # State of the recalculation in progress
+        self.depths: Dict[Cell, int] = {}
+        self.incoming: Dict[Cell, Tuple[float, Optional[Cell]]] = {}
+        self.chain_times: Dict[Cell, float] = {}
+        self.predecessors: Dict[Cell, Optional[Cell]] = {}
+
+    def begin(self, dirty: Dict[Cell, List[Cell]]) -> None:
+        self.recalculations += 1
+        self.fanout += sum(map(len, dirty.values()))
+        self.depths, self.incoming, self.chain_times, self.predecessors = {}, {}, {}, {}
+
+    def update(self, cell: Cell, dependents: List[Cell]) -> None:
+        """Evaluates a dirty cell for the engine and records it."""
+        started = perf_counter()
+        try:
+            if cell.formula is not None:
+                cell.update()
+        finally:
+            elapsed = perf_counter() - started
+            depth = self.depths.pop(cell, 0)
+            if cell.formula is not None:
+                self.evaluations += 1
+                self.total_time += elapsed
+                cell_profile = self.cells.get(cell)
+                if cell_profile is None:
+                    cell_profile = self.cells[cell] = CellProfile()
+                cell_profile.evaluations += 1
+                cell_profile.total_time += elapsed
+                cell_profile.max_time = max(cell_profile.max_time, elapsed)
+                cell_profile.depth = max(cell_profile.depth, depth)
+            # the slowest chain ending at this cell continues through its dependents
+            chain_time, predecessor = self.incoming.pop(cell, (0.0, None))
+            chain_time += elapsed
+            self.chain_times[cell] = chain_time
+            self.predecessors[cell] = predecessor
+            for dependent in dependents:
+                if depth + 1 > self.depths.get(dependent, 0):
+                    self.depths[dependent] = depth + 1
+                if chain_time > self.incoming.get(dependent, (-1.0, None))[0]:
+                    self.incoming[dependent] = (chain_time, cell)
+
+    def end(self) -> None:
+        if self.chain_times:
+            cell = max(self.chain_times, key=self.chain_times.get)
+            chain_time = self.chain_times[cell]
+            chain = []
+            while cell is not None:
+                chain.append(cell)
+                cell = self.predecessors[cell]
+            chain.reverse()
+            self.slowest_chains.append((chain_time, chain))
+            self.slowest_chains.sort(key=lambda entry: entry[0], reverse=True)
+            del self.slowest_chains[self.CHAINS_KEPT:]
+        self.depths, self.incoming, self.chain_times, self.predecessors = {}, {}, {}, {}
+
+    def cell_name(self, cell: Cell) -> str:
+        """The name of the cell, with its sheet name when it is known (e.g. 'Sheet1!A1')."""
+        if self.sheets is not None:
+            for sheet_name in self.sheets:
+                if self.sheets.is_loaded(sheet_name) and self.sheets[sheet_name] is cell.owner_worksheet:
+                    return f"{sheet_name}!{cell.get_name()}"
+        return cell.get_name()
+
+    def to_json(self, limit: Optional[int] = None) -> dict:
+        """
+        The measurements as a JSON-serializable dictionary. Cells and formulas
+        are listed by total time, the `limit` slowest ones (all by default).
+        """
+        cells = sorted(self.cells.items(), key=lambda item: item[1].total_time, reverse=True)
+        formulas = {}
+        for cell, cell_profile in cells:
+            text = cell.text
+            entry = formulas.setdefault(text, {"formula": text, "cells": 0, "evaluations": 0, "total_time": 0.0})
+            entry["cells"] += 1
+            entry["evaluations"] += cell_profile.evaluations
+            entry["total_time"] += cell_profile.total_time
+        return {
+            "recalculations": self.recalculations,
+            "evaluations": self.evaluations,
+            "compilations": self.compilations,
+            "fanout": self.fanout,
+            "total_time": self.total_time,
+            "cells": [{"cell": self.cell_name(cell), "formula": cell.text,
+                       "evaluations": cell_profile.evaluations, "total_time": cell_profile.total_time,
+                       "max_time": cell_profile.max_time, "depth": cell_profile.depth}
+                      for cell, cell_profile in cells[:limit]],
+            "formulas": sorted(formulas.values(), key=lambda entry: entry["total_time"], reverse=True)[:limit],
+            "slowest_chains": [{"time": chain_time, "cells": [self.cell_name(cell) for cell in chain]}
+                               for chain_time, chain in self.slowest_chains],
+        }
+
+    def report(self, limit: int = 10) -> str:
+        """The measurements as a readable text report, the `limit` slowest cells and formulas."""
+        data = self.to_json(limit)
+        lines = [f"Recalculations: {data['recalculations']}, evaluations: {data['evaluations']}, "
+                 f"compilations: {data['compilations']}, fan-out: {data['fanout']}, "
+                 f"evaluation time: {data['total_time'] * 1000:.3f} ms",
+                 "", "Slowest cells:"]
+        for entry in data["cells"]:
+            lines.append(f"  {entry['cell']:<16} {entry['total_time'] * 1000:10.3f} ms {entry['evaluations']:8} evals"
+                         f"  depth {entry['depth']:<4} {entry['formula']}")
+        lines += ["", "Slowest formulas:"]
+        for entry in data["formulas"]:
+            lines.append(f"  {entry['total_time'] * 1000:10.3f} ms {entry['evaluations']:8} evals"
+                         f" {entry['cells']:6} cells  {entry['formula']}")
+        lines += ["", "Slowest chains:"]
+        for chain in data["slowest_chains"]:
+            cells = " -> ".join(chain["cells"][:8]) + (" -> ..." if len(chain["cells"]) > 8 else "")
+            lines.append(f"  {chain['time'] * 1000:10.3f} ms {len(chain['cells']):6} cells  {cells}")
+        return "\n".join(lines)
+
+    def dump(self, filename: str, limit: Optional[int] = None) -> None:
+        """Writes the measurements to a file, as JSON if its name ends with .json, else as text."""
+        with open(filename, 'w') as file:
+            if filename.endswith('.json'):
+                json.dump(self.to_json(limit), file, indent=2)
+            else:
+                file.write(self.report(limit or 10) + '\n')
+
+
+# Operations kept one by one by the journal, older ones are merged
+JOURNAL_LIMIT = 100
+# Cells the journal keeps changes of, over all the operations it can undo and redo
+JOURNAL_MAX_CELLS = 1_000_000
+
+
+class TextRun:
+    """
+    The texts of consecutive rows, compactly: numbers written in their usual
+    form are kept in an array sized to the run, other texts by offset.
+    """
+    __slots__ = ('numbers', 'texts')
+
+    def __init__(self) -> None:
+        # NaN where the text is not a plain number
+        self.numbers = array('d')
+        self.texts: Dict[int, str] = {}
+
+    def __len__(self) -> int:
+        return len(self.numbers)
+
+    @staticmethod
+    def number(text: Optional[str]) -> float:
+        """The number a text is the usual form of, else NaN."""
+        try:
+            number = float(text)
+        except (TypeError, ValueError):
+            return math.nan
+        return number if number == number and text == format_number(number) else math.nan
+
+    def append(self, text: Optional[str]) -> None:
+        number = self.number(text)
+        self.numbers.append(number)
+        if number != number and text is not None:
+            self.texts[len(self.numbers) - 1] = text
+
+    def __setitem__(self, offset: int, text: Optional[str]) -> None:
+        number = self.number(text)
+        if number == number:
+            self.numbers[offset] = number
+            self.texts.pop(offset, None)
+        else:
+            self.numbers[offset] = math.nan
+            if text is None:
+                self.texts.pop(offset, None)
+            else:
+                self.texts[offset] = text
+
+    def __getitem__(self, offset: int) -> Optional[str]:
+        number = self.numbers[offset]
+        if number == number:
+            return format_number(number)
+        return self.texts.get(offset)
+
+    def extend(self, other: 'TextRun') -> None:
+        offset = len(self.numbers)
+        self.numbers.extend(other.numbers)
+        self.texts.update((offset + position, text) for position, text in other.texts.items())
+
+
+class ColumnChanges:
+    """
+    The changes an operation made to one column of a worksheet: the rows it
+    changed, as sorted runs of consecutive rows, and the old and new texts of
+    each run (see TextRun), so a block of numbers costs 16 bytes per row and
+    a single cell a few hundred bytes.
+    """
+    __slots__ = ('starts', 'stops', 'old', 'new', 'count')
+
+    def __init__(self) -> None:
+        # runs of rows [start, stop) and their texts
+        self.starts: List[int] = []
+        self.stops: List[int] = []
+        self.old: List[TextRun] = []
+        self.new: List[TextRun] = []
+        self.count = 0
+
+    def __contains__(self, row: int) -> bool:
+        position = bisect_right(self.starts, row) - 1
+        return position >= 0 and row < self.stops[position]
+
+    def items(self) -> Iterator[Tuple[int, Optional[str], Optional[str]]]:
+        """Yields the (row, old text, new text) of the changed rows in order."""
+        for start, old, new in zip(self.starts, self.old, self.new):
+            for offset in range(len(old)):
+                yield start + offset, old[offset], new[offset]
+
+    def record(self, row: int, old_text: Optional[str], new_text: Optional[str]) -> None:
+        """Records the change of a row; a row changed again keeps its first old text."""
+        if self.stops and self.stops[-1] == row:
+            # the next row of a block
+            self.stops[-1] += 1
+            self.old[-1].append(old_text)
+            self.new[-1].append(new_text)
+            self.count += 1
+            return
+        position = bisect_right(self.starts, row) - 1
+        if position >= 0 and row < self.stops[position]:
+            self.new[position][row - self.starts[position]] = new_text
+            return
+        old, new = TextRun(), TextRun()
+        old.append(old_text)
+        new.append(new_text)
+        self.add_run(position + 1, row, old, new)
+        self.count += 1
+
+    def add_run(self, position: int, row: int, old: TextRun, new: TextRun) -> None:
+        """Inserts the run of a row before the run at position, joining its neighbours."""
+        if position < len(self.starts) and self.starts[position] == row + 1:
+            old.extend(self.old[position])
+            new.extend(self.new[position])
+            stop = self.stops[position]
+            del self.starts[position], self.stops[position], self.old[position], self.new[position]
+        else:
+            stop = row + 1
+        if position > 0 and self.stops[position - 1] == row:
+            self.old[position - 1].extend(old)
+            self.new[position - 1].extend(new)
+            self.stops[position - 1] = stop
+        else:
+            self.starts.insert(position, row)
+            self.stops.insert(position, stop)
+            self.old.insert(position, old)
+            self.new.insert(position, new)
+
+    def is_unchanged(self) -> bool:
+        return all(old_text == new_text for _, old_text, new_text in self.items())
+
+
+class Journal:
+    """
+    Undo/redo history of the cell edits of a workbook. Every operation (an
+    edit, or all the edits of a batch or set_range) is kept as a diff: the old
+    and new text of each cell it changed, by column (see ColumnChanges).
+    Undo and redo write the texts back in a batch, so only those cells are
+    relinked and they and their dependents recalculated.
+
+    Beyond `limit` operations the two oldest are merged into a checkpoint,
+    which keeps a single change per cell and is undone in one step. The
+    operations that can be undone and redone hold at most `max_cells` cells
+    together, the oldest ones are dropped beyond that; an operation over
+    `max_cells` cells ends the history there.
+    """
+
+    def __init__(self, engine: RecalcEngine, limit: int = JOURNAL_LIMIT, max_cells: int = JOURNAL_MAX_CELLS) -> None:
+        self.engine = engine
+        self.limit = limit
+        self.max_cells = max_cells
+        # Operations as {(worksheet, column): ColumnChanges}, the oldest first
+        self.undo_stack: List[Dict[Tuple['Worksheet', int], ColumnChanges]] = []
+        self.redo_stack: List[Dict[Tuple['Worksheet', int], ColumnChanges]] = []
+        # Cells held by the operations of both stacks
+        self.cells = 0
+        # Changes of the operation in progress
+        self.pending: Dict[Tuple['Worksheet', int], ColumnChanges] = {}
+
+    def record(self, worksheet: 'Worksheet', row: int, column: int, old_text: Optional[str],
+               new_text: Optional[str]) -> None:
+        """Records the change of a cell, before it is written."""
+        changes = self.pending.get((worksheet, column))
+        if changes is None:
+            changes = self.pending[(worksheet, column)] = ColumnChanges()
+        changes.record(row, old_text, new_text)
+
+    @staticmethod
+    def size(operation: Dict[Tuple['Worksheet', int], ColumnChanges]) -> int:
+        return sum(changes.count for changes in operation.values())
+
+    def close(self) -> None:
+        """Ends the operation in progress, it becomes the one undone next."""
+        operation = self.pending
+        self.pending = {}
+        if all(changes.is_unchanged() for changes in operation.values()):
+            return
+        self.cells -= sum(map(self.size, self.redo_stack))
+        self.redo_stack = []
+        size = self.size(operation)
+        if size > self.max_cells:
+            # the older operations cannot be undone past this one
+            self.undo_stack = []
+            self.cells = 0
+            return
+        self.undo_stack.append(operation)
+        self.cells += size
+        while len(self.undo_stack) > self.limit:
+            self.cells -= self.size(self.undo_stack[0]) + self.size(self.undo_stack[1])
+            self.undo_stack[:2] = [self.merge(self.undo_stack[0], self.undo_stack[1])]
+            self.cells += self.size(self.undo_stack[0])
+        while self.cells > self.max_cells:
+            self.cells -= self.size(self.undo_stack.pop(0))
+
+    @staticmethod
+    def merge(older: Dict[Tuple['Worksheet', int], ColumnChanges],
+              newer: Dict[Tuple['Worksheet', int], ColumnChanges]) -> Dict[Tuple['Worksheet', int], ColumnChanges]:
+        """Merges two consecutive operations into a checkpoint (reusing the older one)."""
+        for key, changes in newer.items():
+            merged = older.get(key)
+            if merged is None:
+                older[key] = changes
+                continue
+            for row, old_text, new_text in changes.items():
+                merged.record(row, old_text, new_text)
+        return older
+
+    def clear(self) -> None:
+        self.undo_stack = []
+        self.redo_stack = []
+        self.cells = 0
+        self.pending = {}
+
+    def forget(self, worksheet: 'Worksheet') -> None:
+        """Drops the changes of the cells of a worksheet, e.g. when it is removed."""
+        for stack in (self.undo_stack, self.redo_stack):
+            stack[:] = [operation for operation in
+                        ({key: changes for key, changes in operation.items() if key[0] is not worksheet}
+                         for operation in stack) if operation]
+        self.cells = sum(map(self.size, self.undo_stack)) + sum(map(self.size, self.redo_stack))
+
+    def undo(self, recalculate: bool = True) -> List[Cell]:
+        """Undoes the last operation, returns the recalculated cells (see replay)."""
+        if not self.undo_stack:
+            return []
+        operation = self.undo_stack.pop()
+        self.redo_stack.append(operation)
+        return self.replay(operation, undo=True, recalculate=recalculate)
+
+    def redo(self, recalculate: bool = True) -> List[Cell]:
+        """Redoes the last undone operation, returns the recalculated cells (see replay)."""
+        if not self.redo_stack:
+            return []
+        operation = self.redo_stack.pop()
+        self.undo_stack.append(operation)
+        return self.replay(operation, undo=False, recalculate=recalculate)
+
+    def replay(self, operation: Dict[Tuple['Worksheet', int], ColumnChanges], undo: bool,
+               recalculate: bool = True) -> List[Cell]:
+        """
+        Writes back the old (undo) or new texts of an operation. With
+        recalculate=False the formulas are linked but the written cells are
+        returned for the caller to recalculate (e.g. with a RecalcJob); an
+        invalid formula then leaves its cell without a value.
+        """
+        # the writes of undo and redo are not recorded as new operations
+        self.engine.journal = None
+        try:
+            if not recalculate:
+                written = []
+                for (worksheet, column), changes in operation.items():
+                    for row, old_text, new_text in changes.items():
+                        cell = Cell(worksheet, row=row, column=column)
+                        try:
+                            cell.insert_text(old_text if undo else new_text, recalculate=False)
+                        except ValueError:
+                            pass
+                        written.append(cell)
+                return written
+            with self.engine.batch() as recalculated:
+                for (worksheet, column), changes in operation.items():
+                    for row, old_text, new_text in changes.items():
+                        Cell(worksheet, row=row, column=column).insert_text(old_text if undo else new_text)
+        finally:
+            self.engine.journal = self
+        return recalculated
+
+
+class RecalcJob:
+    """
+    A recalculation meant to run on a worker thread. The edits are made with
+    Cell.insert_text(text, recalculate=False) while holding the engine lock,
+    then a job recalculates their cells. A job can be cancelled at any time:
+    it stops before its next cell and `remaining` lists the cells it did not
+    evaluate, to be passed on to the next job.
+    """
+
+    def __init__(self, engine: RecalcEngine, cells: Iterable[Cell]) -> None:
+        self.engine = engine
+        self.cells = list(dict.fromkeys(cells))
+        self.cancelled = threading.Event()
+        # Cells that will be recalculated, known once the job has started
+        self.pending: List[Cell] = []
+        self.recalculated: List[Cell] = []
+        self.remaining: List[Cell] = list(self.cells)
+        self.error: Optional[ValueError] = None
+
+    def cancel(self) -> None:
+        self.cancelled.set()
+
+    def run(self) -> None:
+        with self.engine.lock:
+            if self.cancelled.is_set():
+                return
+            dirty = self.engine.mark_dirty(self.cells)
+            self.pending = list(dirty)
+            try:
+                self.recalculated = self.engine.evaluate(dirty, self.cancelled)
+                self.remaining = []
+            except RecalculationCancelled as e:
+                self.remaining = e.remaining
+            except ValueError as e:
+                self.error = e
+                self.remaining = []
+
 
 class Worksheet:
     """
@@ -142,93 +1260,380 @@ class Worksheet:
     it consists of a grid of cells organized in rows and columns where users
     can enter, calculate, manipulate, and analyze data.
     """
-    def __init__(self, rows: int = 10, columns: int = 10) -> None:
+    def __init__(self, rows: int = 10, columns: int = 10, engine: Optional[RecalcEngine] = None) -> None:
         # Setting default dimensions
         self.num_rows = rows
         self.num_columns = columns
+        # Sheets of the same workbook share its recalculation engine
+        self.engine = engine if engine is not None else RecalcEngine()
 
-        # Creating a sheet as a 2D list consisting of Cell objects
-        self.table = []
-        for row in range(self.num_rows):
-            new_row = []
-            for column in range(self.num_columns):
-                # Adding a new Cell object to each column in the row
-                new_row.append(Cell(self))
-            self.table.append(new_row)
+        # Cell contents are stored by column, see Column. Cells are only views
+        # of a position, so empty cells cost nothing
+        self.columns: Dict[int, Column] = {}
+        # Dependency state, kept only for cells that take part in formulas
+        self.formulas: Dict[Tuple[int, int], Formula] = {}
+        self.subscribers: Dict[Tuple[int, int], Dict[Cell, None]] = {}
+        self.subscriptions: Dict[Tuple[int, int], List[Union[Cell, CellRange]]] = {}
+        # Cells whose formulas use a range, indexed by the columns of the range
+        # and then by the blocks of CHUNK_SIZE rows it overlaps, so a changed
+        # cell only checks the ranges near its row
+        self.range_subscribers: Dict[int, Dict[int, Dict[Tuple[CellRange, Cell], None]]] = {}
 
     def expand_rows(self) -> None:
-        # Creating a new row with a new Cell in each column
-        new_row = [Cell(self) for _ in range(self.num_columns)]
-        # Adding the new row to the table
-        self.table.append(new_row)
-        # Updating the row count
+        # Cells of the new row are created when they are accessed
         self.num_rows += 1
 
     def expand_columns(self) -> None:
-        # Adding a new Cell to each existing row
-        for row in self.table:
-            row.append(Cell(self))
-        # Updating the column count
+        # Cells of the new column are created when they are accessed
         self.num_columns += 1
 
-    def set_cell_value(self, row: int, column: int, value) -> None: # TODO: union type str or float
+    def set_cell_value(self, row: int, column: int, value: Union[str, float, None]) -> None:
         if 0 <= row < self.num_rows and 0 <= column < self.num_columns:
-            self.table[row][column].set_value(value)
+            self.get_cell(row, column).insert_text(to_text(value))
         else:
             print(f"Attempted to set value in cell at ({row}, {column}) which is not in the worksheet.")
 
+    def set_range(self, first_row: int, first_column: int, rows: Iterable[Iterable[Union[str, float, None]]],
+                  undoable: bool = True) -> List[Cell]:
+        """
+        Writes a block of values (texts, formulas or numbers, e.g. a list of
+        rows or a 2D array) with its top-left corner at the given position,
+        growing the worksheet if needed. The values are stored directly in the
+        columns; formulas are linked and the affected cells recalculated once,
+        when the write is complete. Returns the recalculated cells.
+        With undoable=False (e.g. for an import) the write is not kept in the
+        undo history, and the history before it is dropped.
+        """
+        journal = self.engine.journal
+        if journal is not None and not undoable:
+            journal.clear()
+            journal = None
+        with self.engine.batch() as recalculated:
+            for row, values in enumerate(rows, first_row):
+                for column, value in enumerate(values, first_column):
+                    if row >= self.num_rows:
+                        self.num_rows = row + 1
+                    if column >= self.num_columns:
+                        self.num_columns = column + 1
+                    text = to_text(value)
+                    is_formula = text is not None and text.startswith('=')
+                    number = float(text) if not is_formula and is_float(text) else None
+                    storage = self.column_storage(column)
+                    if journal is not None:
+                        journal.record(self, row, column, storage.get_text(row), text)
+                    storage.set(row, number, text)
+                    # only cells taking part in formulas need linking or recalculation
+                    if (is_formula or (row, column) in self.formulas or (row, column) in self.subscribers
+                            or row // CHUNK_SIZE in self.range_subscribers.get(column, ())):
+                        self.engine.pending[Cell(self, row=row, column=column)] = None
+        return recalculated
+
 
     def get_cell(self, row: int, column: int) -> Cell:
+        """
+        Returns a view of the cell at the given position.
+        """
         if 0 <= row < self.num_rows and 0 <= column < self.num_columns:
-            return self.table[row][column]
+            return Cell(self, row=row, column=column)
         else:
             raise ValueError(f"Attempted to access cell at ({row}, {column}) which is not in the worksheet.")
 
+    def column_storage(self, column: int) -> Column:
+        """
+        Returns the storage of a column, creating it on first use.
+        """
+        storage = self.columns.get(column)
+        if storage is None:
+            storage = Column()
+            self.columns[column] = storage
+        return storage
+
     def get_cell_value(self, row: int, column: int) -> float:
-        cell = self.get_cell(row, column)
-        if isinstance(cell, Cell):
-            return cell.get_value()
-        else:
-            raise ValueError("The cell at the specified location is not a valid Cell object")
+        if not (0 <= row < self.num_rows and 0 <= column < self.num_columns):
+            raise ValueError(f"Attempted to access cell at ({row}, {column}) which is not in the worksheet.")
+        storage = self.columns.get(column)
+        return None if storage is None else storage.get_value(row)
+
+    def get_cell_text(self, row: int, column: int) -> Optional[str]:
+        if not (0 <= row < self.num_rows and 0 <= column < self.num_columns):
+            raise ValueError(f"Attempted to access cell at ({row}, {column}) which is not in the worksheet.")
+        storage = self.columns.get(column)
+        return None if storage is None else storage.get_text(row)
+
+    def iter_sparse_rows(self) -> Iterator[Tuple[int, List[list]]]:
+        """
+        Yields the rows that hold data, in order, as (row, cells). Each cell is
+        [column, value] when its text is just the written number, otherwise
+        [column, value, text]. Empty cells and rows are skipped.
+        """
+        columns = sorted(self.columns.items())
+        used_rows = set()
+        for _, storage in columns:
+            used_rows.update(storage.rows())
+        for row in sorted(used_rows):
+            cells = []
+            for column, storage in columns:
+                value = storage.get_value(row)
+                if row in storage.texts:
+                    text = storage.texts[row]
+                    if value is not None or text is not None:
+                        cells.append([column, value, text])
+                elif value is not None:
+                    cells.append([column, value])
+            yield row, cells
+
+    def load_sparse_row(self, row: int, cells: Iterable[list]) -> List[Cell]:
+        """
+        Stores a row in the format of iter_sparse_rows. Formulas are not linked,
+        the cells holding them are returned so they can be linked once every
+        sheet is loaded.
+        """
+        formula_cells = []
+        for cell_data in cells:
+            column, value = cell_data[0], cell_data[1]
+            text = cell_data[2] if len(cell_data) > 2 else format_number(value)
+            self.column_storage(column).set(row, value, text)
+            if isinstance(text, str) and text.startswith('='):
+                formula_cells.append(self.get_cell(row, column))
+        return formula_cells
+
+    def get_state(self) -> tuple:
+        """
+        Returns the contents of the worksheet as a picklable (rows, columns,
+        column storage) tuple, e.g. to hand the sheet to a worker process.
+        Formulas are kept as their text only.
+        """
+        return self.num_rows, self.num_columns, self.columns
+
+    def load_state(self, state: tuple) -> List[Cell]:
+        """
+        Replaces the contents of the worksheet with a state from get_state.
+        Like load_sparse_row, the formulas are not linked and their cells are
+        returned.
+        """
+        self.num_rows, self.num_columns, self.columns = state
+        return [Cell(self, row=row, column=column) for column, storage in self.columns.items()
+                for row, text in storage.texts.items() if isinstance(text, str) and text.startswith('=')]
+
+    def formula_cells(self) -> List[Cell]:
+        """
+        Returns the cells that hold a formula.
+        """
+        return [Cell(self, row=row, column=column) for row, column in self.formulas]
+
+    def dependent_cells(self) -> List[Cell]:
+        """
+        Returns the cells, on this sheet or on other sheets, whose formulas
+        reference cells or ranges of this sheet.
+        """
+        cells = {}
+        for subscribers in self.subscribers.values():
+            cells.update(subscribers)
+        for buckets in self.range_subscribers.values():
+            for subscribers in buckets.values():
+                cells.update((cell, None) for _, cell in subscribers)
+        return list(cells)
+
+    def referenced_sheets(self) -> Set[str]:
+        """
+        Returns the names of the other sheets the formulas of this sheet reference.
+        """
+        return {split_reference(reference)[0] for formula in self.formulas.values()
+                for reference in formula.references if '!' in reference}
 
     def get_cell_indices(self, cell_name: str) -> tuple[int, int]:
         """
         Convert a cell name (e.g., 'A1', 'B3') to row and column indices.
         """
-        match = re.match(r"([A-Za-z]+)(\d+)", cell_name)
-        if not match:
-            raise ValueError("Invalid cell name format")
-
-        column_letters, row_number = match.groups()
-        column_index = column_letter_to_index(column_letters)  # Assuming this method is defined correctly
-        row_index = int(row_number) - 1
-        return row_index, column_index
+        return parse_cell_name(cell_name)
 
     def get_cell_by_reference(self, cell_name: str) -> Cell:
-        if self.cell_exists(cell_name):
-            row_index, column_index = self.get_cell_indices(cell_name)
-            return self.get_cell(row_index, column_index)
+        try:
+            row_index, column_index = parse_cell_name(cell_name)
+        except ValueError:
+            raise ValueError("Cell does not exist")
+        if self.is_valid_position(row_index, column_index):
+            return Cell(self, row=row_index, column=column_index)
         else:
             raise ValueError("Cell does not exist")
 
+    def get_range(self, range_name: str) -> 'CellRange':
+        """
+        Returns the range of cells named like 'A1:B5' (in any corner order).
+        """
+        first_name, _, last_name = range_name.partition(':')
+        try:
+            first_row, first_column = parse_cell_name(first_name)
+            last_row, last_column = parse_cell_name(last_name)
+        except ValueError:
+            raise ValueError(f"Range {range_name} is not in the worksheet.")
+        if not (self.is_valid_position(first_row, first_column) and self.is_valid_position(last_row, last_column)):
+            raise ValueError(f"Range {range_name} is not in the worksheet.")
+        return CellRange(self, min(first_row, last_row), min(first_column, last_column),
+                         max(first_row, last_row), max(first_column, last_column))
+
+    def subscribe_range(self, cell_range: 'CellRange', cell: Cell) -> None:
+        """
+        Subscribes a cell to every cell of the range with a single interval
+        subscription (indexed under each column and row block of the range).
+        """
+        blocks = range(cell_range.first_row // CHUNK_SIZE, cell_range.last_row // CHUNK_SIZE + 1)
+        for column in range(cell_range.first_column, cell_range.last_column + 1):
+            buckets = self.range_subscribers.setdefault(column, {})
+            for block in blocks:
+                buckets.setdefault(block, {})[(cell_range, cell)] = None
+
+    def unsubscribe_range(self, cell_range: 'CellRange', cell: Cell) -> None:
+        blocks = range(cell_range.first_row // CHUNK_SIZE, cell_range.last_row // CHUNK_SIZE + 1)
+        for column in range(cell_range.first_column, cell_range.last_column + 1):
+            buckets = self.range_subscribers.get(column, {})
+            for block in blocks:
+                subscribers = buckets.get(block)
+                if subscribers is None:
+                    continue
+                subscribers.pop((cell_range, cell), None)
+                if not subscribers:
+                    del buckets[block]
+            if not buckets:
+                self.range_subscribers.pop(column, None)
+
     def cell_exists(self, cell_name: str) -> bool:
         """
         Checks if a cell exists in the worksheet by its name.
         """
         try:
-            row_index, column_index = self.get_cell_indices(cell_name)
-            return 0 <= row_index < self.num_rows and 0 <= column_index < self.num_columns
+            row_index, column_index = parse_cell_name(cell_name)
         except ValueError:
             return False
+        return self.is_valid_position(row_index, column_index)
+
+    def is_valid_position(self, row: int, column: int) -> bool:
+        """
+        Checks if a (row, column) position is inside the worksheet.
+        """
+        return 0 <= row < self.num_rows and 0 <= column < self.num_columns
+
+    def recalculate(self) -> List[Cell]:
+        """
+        Recalculates every formula in the worksheet in dependency order.
+        """
+        return self.engine.recalculate(self.formula_cells())
 
 
 
+class CellRange(RangeArgument):
+    """
+    A rectangular range of cells in a worksheet (e.g. A1:C1000). Formulas get
+    ranges as a whole and aggregate them in batches over the column storage.
+    """
+    __slots__ = ('worksheet', 'first_row', 'first_column', 'last_row', 'last_column')
+
+    def __init__(self, worksheet: Worksheet, first_row: int, first_column: int, last_row: int, last_column: int) -> None:
+        self.worksheet = worksheet
+        self.first_row = first_row
+        self.first_column = first_column
+        self.last_row = last_row
+        self.last_column = last_column
+
+    def __eq__(self, other: object) -> bool:
+        return (isinstance(other, CellRange) and self.worksheet is other.worksheet
+                and (self.first_row, self.first_column, self.last_row, self.last_column)
+                == (other.first_row, other.first_column, other.last_row, other.last_column))
+
+    def __hash__(self) -> int:
+        return hash((self.first_row, self.first_column, self.last_row, self.last_column))
+
+    def __repr__(self) -> str:
+        return f"CellRange({self.get_name()})"
+
+    def get_name(self) -> str:
+        first = f"{column_index_to_letter(self.first_column)}{self.first_row + 1}"
+        last = f"{column_index_to_letter(self.last_column)}{self.last_row + 1}"
+        return f"{first}:{last}"
+
+    def shape(self) -> Tuple[int, int]:
+        return self.last_row - self.first_row + 1, self.last_column - self.first_column + 1
+
+    def value_at(self, row: int, column: int) -> Any:
+        storage = self.worksheet.columns.get(self.first_column + column)
+        return None if storage is None else storage.lookup_value(self.first_row + row)
+
+    def find_in_column(self, key: Any, match_type: int) -> Optional[int]:
+        storage = self.worksheet.columns.get(self.first_column)
+        if storage is None or key is None:
+            return None
+        row = storage.lookup_index().find(key, match_type, self.first_row, self.last_row)
+        return None if row is None else row - self.first_row
+
+    def find(self, key: Any, match_type: int) -> Optional[int]:
+        rows, columns = self.shape()
+        if rows > 1 and columns > 1:
+            raise ValueError(f"Range {self.get_name()} is not a single row or column")
+        if columns == 1:
+            return self.find_in_column(key, match_type)
+        # along a row there is no index, the few cells are compared one by one
+        keys = []
+        for column in range(self.first_column, self.last_column + 1):
+            storage = self.worksheet.columns.get(column)
+            keys.append(None if storage is None else storage.lookup_key(self.first_row))
+        return match_position(keys, key, match_type)
+
+    def count_if(self, operator_text: str, key: Any) -> int:
+        # the range covers whole columns when it spans every row of the sheet
+        whole_columns = self.first_row == 0 and self.last_row >= self.worksheet.num_rows - 1
+        count = 0
+        for column in range(self.first_column, self.last_column + 1):
+            storage = self.worksheet.columns.get(column)
+            if storage is not None:
+                count += storage.lookup_index().count(operator_text, key, self.first_row, self.last_row,
+                                                      whole_columns)
+            elif operator_text == '<>':
+                count += self.last_row - self.first_row + 1
+        return count
+
+    def number_batches(self) -> Iterator[array]:
+        for column in range(self.first_column, self.last_column + 1):
+            storage = self.worksheet.columns.get(column)
+            if storage is not None:
+                yield from storage.number_batches(self.first_row, self.last_row)
+
+
 # General functions that the worksheet class uses
 
 
 def column_letter_to_index(letter: str) -> int:
-    """Convert column letter to index (e.g., 'A' -> 0, 'B' -> 1, ...)"""
-    return ord(letter.upper()) - ord('A')
+    """Convert column letters to index (e.g., 'A' -> 0, 'B' -> 1, 'Z' -> 25, 'AA' -> 26, ...)"""
+    index = 0
+    for character in letter.upper():
+        index = index * 26 + ord(character) - ord('A') + 1
+    return index - 1
+
+
+# Parsed cell names are cached, formulas and ranges reuse the same few names
+CELL_NAME_CACHE_SIZE = 1 << 16
+
+
+@lru_cache(maxsize=CELL_NAME_CACHE_SIZE)
+def parse_cell_name(cell_name: str) -> Tuple[int, int]:
+    """
+    Convert a cell name (e.g., 'A1', 'AB12') to (row, column) indices.
+    Results are kept in a bounded LRU cache.
+    """
+    letters = cell_name.rstrip('0123456789')
+    digits = cell_name[len(letters):]
+    if not (letters.isascii() and letters.isalpha() and digits):
+        raise ValueError("Invalid cell name format")
+    return int(digits) - 1, column_letter_to_index(letters)
+
+
+def column_index_to_letter(index: int) -> str:
+    """Convert column index to letters (e.g., 0 -> 'A', 25 -> 'Z', 26 -> 'AA')"""
+    letters = ""
+    index += 1
+    while index > 0:
+        index, remainder = divmod(index - 1, 26)
+        letters = chr(ord('A') + remainder) + letters
+    return letters
 
 
 """
@@ -238,18 +1643,58 @@ def compute_if(condition: bool, true_val: Any, false_val: Any) -> Any:
         return true_val
     else:
         return false_val
+"""
 
 
-def count_if(self, start_row: int, end_row: int, start_col: int, end_col: int, criterion: Callable[[Any], bool]) -> int:
-    #Counts cells in a specified range that meet the given criterion.
-    count = 0
-    for row in range(start_row, end_row + 1):
-        for col in range(start_col, end_col + 1):
-            cell = self.get_cell(row, col)
-            if criterion(cell.get_value()):
-                count += 1
-    return count
-"""
+class SheetMap(MutableMapping):
+    """
+    The sheets of a workbook by name, in insertion order. A sheet can also be
+    added as a loader that builds it the first time it is accessed, so the
+    sheets of a large file that are never used are never materialized.
+    """
+
+    def __init__(self) -> None:
+        self.loaded: Dict[str, Optional[Worksheet]] = {}
+        self.loaders: Dict[str, Callable[[], Worksheet]] = {}
+
+    def add_loader(self, sheet_name: str, loader: Callable[[], Worksheet]) -> None:
+        self.loaded[sheet_name] = None
+        self.loaders[sheet_name] = loader
+
+    def is_loaded(self, sheet_name: str) -> bool:
+        return self.loaded.get(sheet_name) is not None
+
+    def __getitem__(self, sheet_name: str) -> Worksheet:
+        worksheet = self.loaded[sheet_name]
+        if worksheet is None:
+            worksheet = self.loaders.pop(sheet_name)()
+            self.loaded[sheet_name] = worksheet
+        return worksheet
+
+    def __setitem__(self, sheet_name: str, worksheet: Worksheet) -> None:
+        self.loaders.pop(sheet_name, None)
+        self.loaded[sheet_name] = worksheet
+
+    def __delitem__(self, sheet_name: str) -> None:
+        del self.loaded[sheet_name]
+        self.loaders.pop(sheet_name, None)
+
+    def rename(self, sheet_name: str, new_name: str) -> None:
+        """Renames a sheet, keeping its position in the order of the sheets."""
+        self.loaded = {new_name if name == sheet_name else name: worksheet
+                       for name, worksheet in self.loaded.items()}
+        if sheet_name in self.loaders:
+            self.loaders[new_name] = self.loaders.pop(sheet_name)
+
+    def __contains__(self, sheet_name: object) -> bool:
+        # checking a name must not load the sheet
+        return sheet_name in self.loaded
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.loaded)
+
+    def __len__(self) -> int:
+        return len(self.loaded)
 
 
 class Workbook:
@@ -258,30 +1703,150 @@ class Workbook:
     """
 
     def __init__(self) -> None:
-        self.sheets: Dict[str, Worksheet] = {}
+        self.sheets: SheetMap = SheetMap()
+        self.engine = RecalcEngine()
+        # the engine resolves references to other sheets (e.g. Sheet2!A1)
+        self.engine.sheets = self.sheets
+        self.journal = Journal(self.engine)
+        self.engine.journal = self.journal
 
     def add_sheet(self, sheet_name: str) -> None:
         """Add a new sheet with a given name if it doesn't already exist."""
         if sheet_name not in self.sheets:
-            self.sheets[sheet_name] = Worksheet()
+            self.relink(self.install_sheet(sheet_name, Worksheet(engine=self.engine)))
         else:
             print(f"Sheet '{sheet_name}' already exists.")
 
+    def install_sheet(self, sheet_name: str, worksheet: Optional[Worksheet] = None,
+                      loader: Optional[Callable[[], Worksheet]] = None) -> List[Cell]:
+        """
+        Puts a sheet, or a loader building it (see SheetMap), under a name,
+        replacing the sheet with that name if there is one. Returns the cells
+        to relink once every sheet being added is in place: the cells of other
+        sheets that referenced the replaced sheet, and the cells waiting for a
+        sheet with this name.
+        """
+        with self.engine.lock:
+            dependents = []
+            if self.sheets.is_loaded(sheet_name):
+                dependents = self.detach_sheet(self.sheets[sheet_name])
+            if loader is not None:
+                self.sheets.add_loader(sheet_name, loader)
+            else:
+                self.sheets[sheet_name] = worksheet
+            return [*dependents, *self.engine.unresolved.get(sheet_name, ())]
+
+    def detach_sheet(self, worksheet: Worksheet) -> List[Cell]:
+        """
+        Unlinks the formulas of a sheet that is removed or replaced and drops
+        its pending edits and undo history. Returns the cells of other sheets
+        that referenced it, to relink once the sheet is gone.
+        """
+        dependents = [cell for cell in worksheet.dependent_cells() if cell.owner_worksheet is not worksheet]
+        for cell in worksheet.formula_cells():
+            cell.unlink_formula()
+        # formulas of the sheet still waiting for a sheet are not linked
+        self.engine.forget_unresolved_sheet(worksheet)
+        for cell in list(self.engine.pending):
+            if cell.owner_worksheet is worksheet:
+                del self.engine.pending[cell]
+        self.journal.forget(worksheet)
+        return dependents
+
     def get_sheet(self, sheet_name: str) -> Optional[Worksheet]:
         """Retrieve a sheet by name."""
         return self.sheets.get(sheet_name, None)
 
     def remove_sheet(self, sheet_name: str) -> None:
-        """Remove a sheet by name, if it exists."""
+        """
+        Remove a sheet by name, if it exists. Cells of other sheets whose
+        formulas reference it lose their value (and so do their dependents)
+        until a sheet with that name is added again.
+        """
         if sheet_name in self.sheets:
-            del self.sheets[sheet_name]
+            with self.engine.lock:
+                dependents = self.detach_sheet(self.sheets[sheet_name])
+                del self.sheets[sheet_name]
+                self.relink(dependents)
         else:
             print(f"Sheet '{sheet_name}' does not exist.")
 
+    def rename_sheet(self, sheet_name: str, new_name: str) -> None:
+        """
+        Rename a sheet. References are by name: cells referencing the old name
+        lose their value like when the sheet is removed, and cells that were
+        waiting for a sheet called new_name are linked to this one.
+        """
+        if sheet_name not in self.sheets:
+            print(f"Sheet '{sheet_name}' does not exist.")
+        elif new_name in self.sheets:
+            print(f"Sheet '{new_name}' already exists.")
+        else:
+            with self.engine.lock:
+                worksheet = self.sheets[sheet_name]
+                dependents = [cell for cell in worksheet.dependent_cells()
+                              if any(split_reference(reference)[0] == sheet_name
+                                     for reference in cell.formula.references)]
+                self.sheets.rename(sheet_name, new_name)
+                self.relink([*dependents, *self.engine.unresolved.get(new_name, ())])
+
+    def relink(self, cells: Iterable[Cell]) -> List[Cell]:
+        """
+        Links the formulas of the cells again after the sheets they reference
+        changed, and recalculates them and their dependents. The cells whose
+        references are broken are left without a value. Cells of sheets that
+        are no longer in the workbook (e.g. replaced by a load) are skipped.
+        """
+        sheets = {worksheet for worksheet in self.sheets.loaded.values() if worksheet is not None}
+        try:
+            with self.engine.batch() as recalculated:
+                self.engine.pending.update(dict.fromkeys(cell for cell in cells if cell.owner_worksheet in sheets))
+        except ValueError:
+            pass  # the cells with broken references have no value
+        return recalculated
+
     def list_sheets(self) -> List[str]:
         """List all sheet names in the workbook."""
         return list(self.sheets.keys())
 
+    def undo(self, recalculate: bool = True) -> List[Cell]:
+        """
+        Undoes the last cell edit (or batch of edits) on any sheet and returns
+        the recalculated cells. Adding, renaming and removing sheets is not undone.
+        With recalculate=False the cells written back are returned instead,
+        for the caller to recalculate (see Journal.replay).
+        """
+        return self.journal.undo(recalculate)
+
+    def redo(self, recalculate: bool = True) -> List[Cell]:
+        """Redoes the last undone edit and returns the recalculated cells (see undo)."""
+        return self.journal.redo(recalculate)
+
+    def start_profiling(self) -> RecalcProfile:
+        """
+        Starts measuring the recalculations of the workbook (see RecalcProfile)
+        and returns the profile being filled. Recalculations done in worker
+        processes are not measured.
+        """
+        self.engine.profile = RecalcProfile(self.sheets)
+        return self.engine.profile
+
+    def stop_profiling(self) -> Optional[RecalcProfile]:
+        """Stops measuring, returns the profile filled since start_profiling."""
+        profile, self.engine.profile = self.engine.profile, None
+        return profile
+
+    def batch(self):
+        """
+        Context manager deferring formula linking and recalculation of every
+        cell written inside it (on any sheet) to a single pass when it exits:
+
+            with workbook.batch():
+                sheet.set_cell_value(0, 0, 1)
+                sheet.set_cell_value(0, 1, "=A1 + 1")
+        """
+        return self.engine.batch()
+
     def expand_sheet(self, sheet_name: str, rows: bool = False, columns: bool = False) -> None:
         sheet = self.get_sheet(sheet_name)
         if sheet:
@@ -292,36 +1857,168 @@ class Workbook:
         else:
             print(f"Sheet '{sheet_name}' does not exist.")
 
-    def load_from_json(self, data):
-        for sheet_name, sheet_data in data.items():
-            worksheet = Worksheet(rows=len(sheet_data), columns=(len(sheet_data[0])))
-            for row_index, row in enumerate(sheet_data):
-                for column_index, cell_data in enumerate(row):
-                    cell = worksheet.table[row_index][column_index] # TODO: implement differently don't access table
-                    cell.set(cell_data[0], cell_data[1])
-                    if cell.text and cell.text.startswith('='):
-                        cell_names = re.findall(r'[A-Za-z]+\d+', cell.text) # TODO: fix it to work also for A10
-                        for cell_name in cell_names:
-                            cell_to_subscribe = worksheet.get_cell_by_reference(cell_name)
-                            if cell_to_subscribe not in cell.subscriptions:
-                                cell_to_subscribe.subscribe(cell)
-                                cell.subscriptions.append(cell_to_subscribe)
-            self.sheets[sheet_name] = worksheet
-
-    def to_json(self):
+    def sheet_groups(self) -> List[List[str]]:
+        """
+        Partitions the sheets into groups that can be processed independently
+        of each other, e.g. recalculated in separate processes: sheets linked
+        by references between them, directly or through other sheets, are in
+        the same group.
+        """
+        group_of = {sheet_name: [sheet_name] for sheet_name in self.sheets}
+        for sheet_name in self.sheets:
+            for other_name in self.sheets[sheet_name].referenced_sheets():
+                group, other_group = group_of[sheet_name], group_of.get(other_name)
+                if other_group is None or other_group is group:
+                    continue
+                group.extend(other_group)
+                for name in other_group:
+                    group_of[name] = group
+        groups = {}
+        for sheet_name in self.sheets:
+            groups.setdefault(id(group_of[sheet_name]), []).append(sheet_name)
+        return list(groups.values())
+
+    def recalculate(self, workers: Optional[int] = None) -> List[Cell]:
+        """
+        Recalculates every formula of every sheet in dependency order. With
+        workers > 1 the independent groups of sheets (see sheet_groups) are
+        recalculated in that many processes; the values and errors are the
+        same as in a serial run.
+        """
+        if _use_processes(workers, len(self.sheets)):
+            return self.recalculate_in_processes(workers)
+        formula_cells = []
+        for worksheet in self.sheets.values():
+            formula_cells.extend(worksheet.formula_cells())
+        return self.engine.recalculate(formula_cells)
+
+    def recalculate_in_processes(self, workers: int) -> List[Cell]:
+        with self.engine.lock:
+            states = [[(sheet_name, self.sheets[sheet_name].get_state()) for sheet_name in group]
+                      for group in self.sheet_groups()]
+            recalculated, cycle, errors = [], [], []
+            for values, cycle_positions, error in _map_in_processes(_recalculate_sheets, states, workers):
+                for sheet_name, row, column, value in values:
+                    cell = Cell(self.sheets[sheet_name], row=row, column=column)
+                    cell.value = value
+                    recalculated.append(cell)
+                for sheet_name, row, column in cycle_positions:
+                    cell = Cell(self.sheets[sheet_name], row=row, column=column)
+                    cell.value = None
+                    cycle.append(cell)
+                if error is not None:
+                    errors.append(error)
+        if cycle:
+            raise CircularReferenceError(cycle)
+        if errors:
+            raise ValueError(errors[0])
+        return recalculated
+
+    def load_from_json(self, data, workers: Optional[int] = None):
+        formula_cells = []
+        if _use_processes(workers, len(data)):
+            states = _map_in_processes(_dense_sheet_state, data.values(), workers)
+        else:
+            states = map(_dense_sheet_state, data.values())
+        waiting = []
+        for sheet_name, state in zip(data, states):
+            worksheet = Worksheet(engine=self.engine)
+            formula_cells.extend(worksheet.load_state(state))
+            waiting.extend(self.install_sheet(sheet_name, worksheet))
+        link_loaded_formulas(formula_cells)
+        self.relink(waiting)
+
+    def load_from_records(self, records: Iterable[Any]) -> None:
+        """
+        Loads sheets from records in the sparse row format (see iter_records),
+        consuming them one at a time.
+        """
+        formula_cells = []
+        waiting = []
+        worksheet = None
+        for record in records:
+            if isinstance(record, dict):
+                if "sheet" in record:
+                    worksheet = Worksheet(rows=record["rows"], columns=record["columns"], engine=self.engine)
+                    waiting.extend(self.install_sheet(record["sheet"], worksheet))
+            else:
+                row_index, cells = record
+                formula_cells.extend(worksheet.load_sparse_row(row_index, cells))
+        link_loaded_formulas(formula_cells)
+        self.relink(waiting)
+
+    def load_from_file(self, filename: str, workers: Optional[int] = None) -> None:
+        """
+        Loads the sheets of a workbook file. Binary columnar files are mapped
+        into memory and their sheets are only built when accessed (see
+        save_workbook_binary). Files in the sparse row format are streamed line
+        by line, files in the older dense JSON format (a single object of
+        [value, text] grids) are parsed whole. With workers > 1 the sheets of
+        JSON files are parsed in that many processes.
+        """
+        with open(filename, 'rb') as file:
+            if file.read(len(BINARY_MAGIC)) == BINARY_MAGIC:
+                load_workbook_binary(self, filename)
+                return
+        with open(filename, 'r') as file:
+            first_line = file.readline()
+            try:
+                header = json.loads(first_line)
+            except ValueError:
+                header = None
+            if isinstance(header, dict) and header.get("format") == SPARSE_FORMAT:
+                if workers and workers > 1:
+                    self.load_sparse_lines_in_processes(file, workers)
+                else:
+                    self.load_from_records(json.loads(line) for line in file if line.strip())
+                return
+            if header is None:
+                # a dense file written with indentation
+                file.seek(0)
+                header = json.load(file)
+            self.load_from_json(header, workers)
+
+    def load_sparse_lines_in_processes(self, lines: Iterable[str], workers: int) -> None:
+        """
+        Loads sheets from the lines of a file in the sparse row format (after
+        its header), parsing every sheet in a separate process.
+        """
+        sheets = []
+        for line in lines:
+            # only the sheet records are objects, rows are arrays
+            if line.startswith('{'):
+                sheets.append([line])
+            elif line.strip():
+                sheets[-1].append(line)
+        formula_cells = []
+        waiting = []
+        for sheet_name, state in _map_in_processes(_sparse_sheet_state, sheets, workers):
+            worksheet = Worksheet(engine=self.engine)
+            formula_cells.extend(worksheet.load_state(state))
+            waiting.extend(self.install_sheet(sheet_name, worksheet))
+        link_loaded_formulas(formula_cells)
+        self.relink(waiting)
+
+    def iter_records(self) -> Iterator[Any]:
+        """
+        Yields the workbook in the sparse row format, one JSON-serializable
+        record at a time: a format header, then for every sheet a record with
+        its name and dimensions followed by its non-empty rows.
+        """
+        yield {"format": SPARSE_FORMAT, "version": 1}
+        for sheet_name, worksheet in self.sheets.items():
+            yield {"sheet": sheet_name, "rows": worksheet.num_rows, "columns": worksheet.num_columns}
+            for row_index, cells in worksheet.iter_sparse_rows():
+                yield [row_index, cells]
+
+    def to_json(self, workers: Optional[int] = None):
         # Convert the entire workbook to a JSON-serializable dictionary
+        if _use_processes(workers, len(self.sheets)):
+            states = [worksheet.get_state() for worksheet in self.sheets.values()]
+            return dict(zip(self.sheets, _map_in_processes(_dense_sheet_data, states, workers)))
         workbook_data = {}
         for sheet_name, worksheet in self.sheets.items():
-            sheet_data = []
-            for row in worksheet.table:
-                row_data = []
-                for cell in row:
-                    cell_data = [
-                        cell.value, cell.text
-                    ]
-                    row_data.append(cell_data)
-                sheet_data.append(row_data)
-            workbook_data[sheet_name] = sheet_data
+            workbook_data[sheet_name] = _dense_sheet_data(worksheet.get_state())
         return workbook_data
 
 # Functions that operate on a range of cells
@@ -330,16 +2027,21 @@ class Workbook:
 def calculate_on_range(worksheet, cell_range: List[str], function: str) -> Union[str, tuple[None, str]]:
     """
     Calculates specified statistics (MAX, MIN, SUM, AVERAGE) of values in the specified cell range within the worksheet.
+    The cell range lists cell names ('A1') and ranges ('A1:C1000'); ranges are
+    reduced in batches over the column storage instead of cell by cell.
     Returns None if all cells are empty or the values are None.
     """
-    functions = {'max': max, 'min': min, 'sum': sum, 'average': statistics.mean}
-    values = []
+    functions = {name: AGGREGATES[name] for name in ('max', 'min', 'sum', 'average')}
+    arguments = []
     for cell_name in cell_range:
+        if ':' in cell_name:
+            arguments.append(worksheet.get_range(cell_name))
+            continue
         row_index, column_index = worksheet.get_cell_indices(cell_name)
-        cell = worksheet.get_cell(row_index, column_index)
-        value = cell.get_value()
-        if value is not None:
-            values.append(value)
+        value = worksheet.get_cell_value(row_index, column_index)
+        if isinstance(value, float):
+            arguments.append(value)
+    values = number_batches(arguments)
     if values:
         result = functions.get(function, lambda x: None)(values)
         if result is not None:
@@ -351,9 +2053,331 @@ def calculate_on_range(worksheet, cell_range: List[str], function: str) -> Union
         return None, f"No valid values found in the cell range {cell_range}. Cannot compute {function}."
 
 
-def save_workbook_as(workbook, filename):
+def link_loaded_formulas(cells: Iterable[Cell]) -> None:
+    """
+    Links the formulas of cells loaded from a file. A formula that fails to
+    link (e.g. it references a sheet that is missing) leaves its cell without
+    a value instead of failing the whole load.
+    """
+    for cell in cells:
+        try:
+            cell.link_formula()
+        except ValueError:
+            cell.value = None
+
+
+def save_workbook_as(workbook, filename, workers: Optional[int] = None):
+    # The workbook is written one record per line as it is generated, without
+    # building a copy of the whole workbook in memory. With workers > 1 the
+    # sheets are serialized in that many processes and written in order
     if filename:
         with open(filename, 'w') as file:
-            json_data = workbook.to_json()
-            json.dump(json_data, file, indent=4)
+            if _use_processes(workers, len(workbook.sheets)):
+                file.write(json.dumps({"format": SPARSE_FORMAT, "version": 1}, separators=(',', ':')) + '\n')
+                states = [(sheet_name, worksheet.get_state()) for sheet_name, worksheet in workbook.sheets.items()]
+                for lines in _map_in_processes(_sparse_sheet_lines, states, workers):
+                    file.write(lines)
+            else:
+                for record in workbook.iter_records():
+                    file.write(json.dumps(record, separators=(',', ':')))
+                    file.write('\n')
             print("Workbook saved to", filename)
+
+
+# Processing sheets in parallel
+#
+# Worker processes get sheets as the picklable state of Worksheet.get_state
+# (compiled formulas and the dependency graph are rebuilt where needed) and
+# return plain values, which are applied to the workbook in sheet order.
+
+
+def _use_processes(workers: Optional[int], sheet_count: int) -> bool:
+    return workers is not None and workers > 1 and sheet_count > 1
+
+
+def _map_in_processes(function: Callable, items: Iterable[Any], workers: int) -> List[Any]:
+    """Applies the function to every item in a pool of processes, results in order."""
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(function, items))
+
+
+def _recalculate_sheets(states: List[Tuple[str, tuple]]) -> tuple:
+    """
+    Recalculates a group of sheets. Returns the (sheet, row, column, value) of
+    the recalculated cells in evaluation order, the (sheet, row, column) of
+    the cells in a cycle and the message of the first error (or None).
+    """
+    workbook = Workbook()
+    names = {}
+    formula_cells = []
+    for sheet_name, state in states:
+        worksheet = Worksheet(engine=workbook.engine)
+        formula_cells.extend(worksheet.load_state(state))
+        workbook.install_sheet(sheet_name, worksheet)
+        names[worksheet] = sheet_name
+    for cell in formula_cells:
+        try:
+            cell.link_formula()
+        except ValueError:
+            pass  # the formula failed to link in the workbook too, its value is None already
+    engine = workbook.engine
+    dirty = engine.mark_dirty([cell for worksheet in names for cell in worksheet.formula_cells()])
+    cycle, error = [], None
+    try:
+        recalculated = engine.evaluate(dirty)
+    except ValueError as e:
+        # the errors are raised once every cell outside a cycle is evaluated
+        cycle = e.cells if isinstance(e, CircularReferenceError) else []
+        error = str(e)
+        cycle_cells = set(cycle)
+        recalculated = [cell for cell in dirty if cell not in cycle_cells]
+    values = [(names[cell.owner_worksheet], cell.row, cell.column, cell.value) for cell in recalculated]
+    cycle_positions = [(names[cell.owner_worksheet], cell.row, cell.column) for cell in cycle]
+    return values, cycle_positions, error
+
+
+def _dense_sheet_state(sheet_data: List[List[list]]) -> tuple:
+    """The state (see Worksheet.get_state) of a sheet in the dense JSON format."""
+    worksheet = Worksheet(rows=len(sheet_data), columns=(len(sheet_data[0])))
+    for row_index, row in enumerate(sheet_data):
+        # empty cells are not stored
+        cells = [[column_index, *cell_data] for column_index, cell_data in enumerate(row)
+                 if cell_data[0] is not None or cell_data[1] is not None]
+        worksheet.load_sparse_row(row_index, cells)
+    return worksheet.get_state()
+
+
+def _dense_sheet_data(state: tuple) -> List[List[list]]:
+    """The [value, text] grid of the dense JSON format for a sheet state."""
+    num_rows, num_columns, columns = state
+    sheet_data = []
+    for row_index in range(num_rows):
+        row_data = []
+        for column_index in range(num_columns):
+            storage = columns.get(column_index)
+            if storage is None:
+                cell_data = [None, None]
+            else:
+                cell_data = [
+                    storage.get_value(row_index), storage.get_text(row_index)
+                ]
+            row_data.append(cell_data)
+        sheet_data.append(row_data)
+    return sheet_data
+
+
+def _sparse_sheet_state(lines: List[str]) -> Tuple[str, tuple]:
+    """The name and state of a sheet from its lines in the sparse row format."""
+    header = json.loads(lines[0])
+    worksheet = Worksheet(rows=header["rows"], columns=header["columns"])
+    for line in lines[1:]:
+        row_index, cells = json.loads(line)
+        worksheet.load_sparse_row(row_index, cells)
+    return header["sheet"], worksheet.get_state()
+
+
+def _sparse_sheet_lines(sheet: Tuple[str, tuple]) -> str:
+    """The lines of a sheet in the sparse row format, from its name and state."""
+    sheet_name, state = sheet
+    worksheet = Worksheet()
+    worksheet.load_state(state)
+    records = [{"sheet": sheet_name, "rows": worksheet.num_rows, "columns": worksheet.num_columns}]
+    records.extend([row_index, cells] for row_index, cells in worksheet.iter_sparse_rows())
+    return ''.join(json.dumps(record, separators=(',', ':')) + '\n' for record in records)
+
+
+# Binary columnar workbook format
+#
+# The file starts with BINARY_MAGIC and the offset of the index. The data of
+# every sheet follows as flat 8-byte aligned arrays: the number chunks of each
+# column, the rows and string ids of its texts, the formulas (rows, columns
+# and string ids) and the string table (offsets and UTF-8 data). The file ends
+# with the index, a JSON document locating the arrays of every sheet.
+
+BINARY_MAGIC = b"XLCOLBK1"
+BINARY_EXTENSION = ".xlcol"
+BINARY_HEADER = struct.Struct('<8sQ')
+
+
+class _ArrayWriter:
+    """Writes the arrays of a binary workbook and returns their [offset, length]."""
+
+    def __init__(self, file) -> None:
+        self.file = file
+
+    def write_bytes(self, data: bytes) -> List[int]:
+        padding = -self.file.tell() % 8
+        self.file.write(b"\0" * padding)
+        offset = self.file.tell()
+        self.file.write(data)
+        return [offset, len(data)]
+
+    def write(self, typecode: str, values: Iterable) -> List[int]:
+        values = array(typecode, values)
+        offset, _ = self.write_bytes(values.tobytes())
+        return [offset, len(values)]
+
+
+class _StringTable:
+    """Strings of a sheet in a binary workbook, decoded when they are used."""
+
+    def __init__(self, data: memoryview, offsets: Sequence[int]) -> None:
+        self.data = data
+        self.offsets = offsets
+
+    def __getitem__(self, string_id: int) -> Optional[str]:
+        if string_id < 0:
+            return None
+        return str(self.data[self.offsets[string_id]:self.offsets[string_id + 1]], 'utf-8')
+
+
+def _write_sheet_binary(writer: _ArrayWriter, sheet_name: str, worksheet: Worksheet) -> dict:
+    strings: Dict[str, int] = {}
+
+    def string_id(text: Optional[str]) -> int:
+        if text is None:
+            return -1
+        return strings.setdefault(text, len(strings))
+
+    columns = []
+    # formula texts are written separately, including the formulas that could
+    # not be linked (e.g. waiting for a sheet), so they are linked on load
+    formula_positions = []
+    for column, storage in sorted(worksheet.columns.items()):
+        chunk_ids = sorted(storage.chunks)
+        text_rows = []
+        for row in sorted(storage.texts):
+            text = storage.texts[row]
+            if isinstance(text, str) and text.startswith('='):
+                formula_positions.append((row, column))
+            else:
+                text_rows.append(row)
+        object_rows = sorted(storage.objects)
+        columns.append({
+            "column": column,
+            "chunk_ids": writer.write('q', chunk_ids),
+            "chunks": writer.write_bytes(b"".join(bytes(storage.chunks[chunk_id]) for chunk_id in chunk_ids)),
+            "text_rows": writer.write('q', text_rows),
+            "text_ids": writer.write('q', [string_id(storage.texts[row]) for row in text_rows]),
+            "object_rows": writer.write('q', object_rows),
+            "object_ids": writer.write('q', [string_id(str(storage.objects[row])) for row in object_rows]),
+        })
+
+    formula_positions.sort()
+    formulas = {
+        "rows": writer.write('q', [row for row, _ in formula_positions]),
+        "columns": writer.write('q', [column for _, column in formula_positions]),
+        "ids": writer.write('q', [string_id(worksheet.get_cell_text(row, column)) for row, column in formula_positions]),
+    }
+
+    encoded = [text.encode('utf-8') for text in strings]
+    return {
+        "name": sheet_name,
+        "rows": worksheet.num_rows,
+        "columns": worksheet.num_columns,
+        "column_data": columns,
+        "formulas": formulas,
+        "string_offsets": writer.write('q', accumulate(map(len, encoded), initial=0)),
+        "string_data": writer.write_bytes(b"".join(encoded)),
+    }
+
+
+def save_workbook_binary(workbook, filename):
+    """
+    Saves the workbook in the binary columnar format: numbers as typed
+    columns, text in a string table and formulas separately, with an index
+    locating the data of every sheet.
+
+    The workbook may have been opened from the same file, with sheets not
+    loaded yet and numbers still read from the mapping, so the file is
+    written under a temporary name that replaces the target once complete.
+    """
+    if filename:
+        temporary = f"{filename}.{os.getpid()}.tmp"
+        try:
+            with open(temporary, 'wb') as file:
+                file.write(BINARY_HEADER.pack(BINARY_MAGIC, 0))
+                writer = _ArrayWriter(file)
+                sheets = [_write_sheet_binary(writer, sheet_name, worksheet)
+                          for sheet_name, worksheet in workbook.sheets.items()]
+                index_offset = file.tell()
+                file.write(json.dumps({"byteorder": sys.byteorder, "sheets": sheets}).encode('utf-8'))
+                file.seek(0)
+                file.write(BINARY_HEADER.pack(BINARY_MAGIC, index_offset))
+            os.replace(temporary, filename)
+        except BaseException:
+            if os.path.exists(temporary):
+                os.remove(temporary)
+            raise
+        print("Workbook saved to", filename)
+
+
+def _read_array(data: mmap.mmap, byteorder: str, typecode: str, location: List[int]) -> Sequence:
+    offset, length = location
+    view = memoryview(data)[offset:offset + length * 8].cast(typecode)
+    if byteorder != sys.byteorder:
+        # written on a machine with the other byte order
+        values = array(typecode, view)
+        values.byteswap()
+        return values
+    return view
+
+
+def _load_sheet_binary(workbook, sheet_name: str, data: mmap.mmap, byteorder: str, sheet: dict) -> Worksheet:
+    read = partial(_read_array, data, byteorder)
+    offset, length = sheet["string_data"]
+    strings = _StringTable(memoryview(data)[offset:offset + length], read('q', sheet["string_offsets"]))
+
+    worksheet = Worksheet(rows=sheet["rows"], columns=sheet["columns"], engine=workbook.engine)
+    for column_data in sheet["column_data"]:
+        storage = worksheet.column_storage(column_data["column"])
+        offset, length = column_data["chunks"]
+        chunks = read('d', [offset, length // 8])
+        # the chunks stay views of the mapped file until they are written to
+        for position, chunk_id in enumerate(read('q', column_data["chunk_ids"])):
+            storage.chunks[chunk_id] = chunks[position * CHUNK_SIZE:(position + 1) * CHUNK_SIZE]
+        for row, string_id in zip(read('q', column_data["text_rows"]), read('q', column_data["text_ids"])):
+            storage.texts[row] = strings[string_id]
+        for row, string_id in zip(read('q', column_data["object_rows"]), read('q', column_data["object_ids"])):
+            storage.objects[row] = strings[string_id]
+
+    formulas = sheet["formulas"]
+    formula_cells = []
+    for row, column, string_id in zip(read('q', formulas["rows"]), read('q', formulas["columns"]),
+                                      read('q', formulas["ids"])):
+        worksheet.column_storage(column).texts[row] = strings[string_id]
+        formula_cells.append(worksheet.get_cell(row, column))
+    # the sheet is in place before its formulas are linked, so the sheets it
+    # references can reference it back while they load
+    workbook.sheets[sheet_name] = worksheet
+    link_loaded_formulas(formula_cells)
+    # the sheets this one references may have changed since the file was saved
+    cross_sheet_cells = [cell for cell in formula_cells if cell.formula is not None
+                         and any('!' in reference for reference in cell.formula.references)]
+    if cross_sheet_cells:
+        try:
+            workbook.engine.recalculate(cross_sheet_cells)
+        except ValueError:
+            pass  # the cells that failed are left without a value
+    return worksheet
+
+
+def load_workbook_binary(workbook, filename):
+    """
+    Opens a binary columnar workbook file by mapping it into memory. Only the
+    index is read; every sheet is built the first time it is accessed, and its
+    numbers stay in the mapped file until they are read or changed.
+    """
+    with open(filename, 'rb') as file:
+        # a private copy-on-write mapping, edits never reach the file
+        data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_COPY)
+    magic, index_offset = BINARY_HEADER.unpack_from(data, 0)
+    if magic != BINARY_MAGIC:
+        raise ValueError(f"{filename} is not a binary workbook file")
+    index = json.loads(data[index_offset:].decode('utf-8'))
+    waiting = []
+    for sheet in index["sheets"]:
+        loader = partial(_load_sheet_binary, workbook, sheet["name"], data, index["byteorder"], sheet)
+        waiting.extend(workbook.install_sheet(sheet["name"], loader=loader))
+    # the sheets referenced by cells that were waiting for them are loaded here
+    workbook.relink(waiting)
@@ -0,0 +1,163 @@
+"""Command line tool to recalculate workbook files without the GUI.
+
+Loads every workbook file given (dense or sparse JSON, or binary columnar),
+recalculates it and writes the values of every sheet as CSV, or the whole
+recalculated workbook in the sparse JSON or the binary format:
+
+    python cli.py book1.json book2.xlcol --format csv --output-dir out
+    python cli.py book.json --sheet Sheet1 --stdout > sheet1.csv
+
+Only the engine modules are imported (no tkinter), files in the sparse
+format are read line by line and CSV is written row by row.
+"""
+
+# Import packages
+from typing import *
+import argparse
+import csv
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from classes import (BINARY_EXTENSION, Column, Workbook, Worksheet, format_number, save_workbook_as,
+                     save_workbook_binary)
+
+
+FORMATS = ("csv", "json", "xlcol")
+
+
+def cell_output(worksheet: Worksheet, row: int, column: int) -> str:
+    """The value of a cell as written in CSV, empty for a formula without a value."""
+    storage = worksheet.columns.get(column)
+    if storage is None:
+        return ""
+    value = storage.get_value(row)
+    if value is None:
+        text = storage.get_text(row)
+        return "" if text is None or text.startswith('=') else text
+    return format_number(value) if isinstance(value, float) else str(value)
+
+
+def iter_csv_rows(worksheet: Worksheet) -> Iterator[List[str]]:
+    """Yields the rows of the sheet up to its last used row and column, empty rows included."""
+    last_row = max((rows[-1] for rows in map(Column.rows, worksheet.columns.values()) if rows), default=None)
+    if last_row is None:
+        return
+    columns = range(max(worksheet.columns) + 1)
+    for row in range(last_row + 1):
+        yield [cell_output(worksheet, row, column) for column in columns]
+
+
+def write_csv(worksheet: Worksheet, file) -> None:
+    writer = csv.writer(file)
+    for row in iter_csv_rows(worksheet):
+        writer.writerow(row)
+
+
+def safe_file_name(name: str) -> str:
+    return "".join(character if character.isalnum() or character in "-_." else "_" for character in name)
+
+
+def output_name(filename: str, arguments: argparse.Namespace) -> str:
+    """
+    The output file of a workbook file, for CSV the prefix of the files of
+    its sheets.
+    """
+    stem = os.path.splitext(os.path.basename(filename))[0]
+    if arguments.format == "csv":
+        return os.path.join(arguments.output_dir, stem + "-")
+    extension = BINARY_EXTENSION if arguments.format == "xlcol" else ".json"
+    return os.path.join(arguments.output_dir, stem + extension)
+
+
+def process_workbook(filename: str, arguments: argparse.Namespace) -> List[str]:
+    """
+    Loads, recalculates and writes out one workbook file. Returns the
+    problems found (e.g. circular references); failures raise.
+    """
+    problems = []
+    workbook = Workbook()
+    workbook.load_from_file(filename, workers=arguments.workers)
+    try:
+        workbook.recalculate(workers=arguments.workers)
+    except ValueError as e:
+        # the cells that failed are written without a value
+        problems.append(str(e))
+
+    output = output_name(filename, arguments)
+    sheet_names = [arguments.sheet] if arguments.sheet else workbook.list_sheets()
+    if arguments.sheet and arguments.sheet not in workbook.sheets:
+        raise ValueError(f"Sheet '{arguments.sheet}' does not exist.")
+    if arguments.stdout and len(sheet_names) > 1:
+        raise ValueError(f"The workbook has {len(sheet_names)} sheets, choose the one to write with --sheet")
+
+    if arguments.format == "csv":
+        for sheet_name in sheet_names:
+            worksheet = workbook.get_sheet(sheet_name)
+            if arguments.stdout:
+                write_csv(worksheet, sys.stdout)
+                continue
+            with open(f"{output}{safe_file_name(sheet_name)}.csv", 'w', newline='') as file:
+                write_csv(worksheet, file)
+        return problems
+
+    if os.path.abspath(output) == os.path.abspath(filename):
+        raise ValueError(f"Writing {output} would overwrite the input, choose another --output-dir")
+    if arguments.format == "xlcol":
+        save_workbook_binary(workbook, output)
+    else:
+        save_workbook_as(workbook, output)
+    return problems
+
+
+def run(filename: str, arguments: argparse.Namespace) -> Tuple[str, List[str], Optional[str]]:
+    """Processes one file, returns (file name, problems, error) instead of raising."""
+    try:
+        return filename, process_workbook(filename, arguments), None
+    except (OSError, ValueError, KeyError, IndexError) as e:
+        return filename, [], f"{type(e).__name__}: {e}"
+
+
+def main(argv: Optional[Sequence[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Recalculate workbook files and write their values.")
+    parser.add_argument("files", nargs="+", help="workbook files (.json or .xlcol)")
+    parser.add_argument("-f", "--format", choices=FORMATS, default="csv",
+                        help="csv: the values of every sheet; json/xlcol: the recalculated workbook (default csv)")
+    parser.add_argument("-o", "--output-dir", default=".", help="directory of the output files (default .)")
+    parser.add_argument("--sheet", help="only write this sheet (csv)")
+    parser.add_argument("--stdout", action="store_true", help="write the CSV of one sheet (see --sheet) to the standard output")
+    parser.add_argument("--jobs", type=int, default=1, help="files processed in parallel processes (default 1)")
+    parser.add_argument("--workers", type=int, help="processes used for the sheets of each workbook")
+    arguments = parser.parse_args(argv)
+    if arguments.stdout and arguments.format != "csv":
+        parser.error("--stdout can only be used with --format csv")
+    if arguments.stdout and len(arguments.files) > 1:
+        parser.error("--stdout can only be used with a single file")
+    if not arguments.stdout:
+        # files with the same name in different directories or with different
+        # extensions would overwrite each other's output
+        outputs = {}
+        for filename in arguments.files:
+            outputs.setdefault(os.path.abspath(output_name(filename, arguments)), []).append(filename)
+        clashes = [", ".join(filenames) for filenames in outputs.values() if len(filenames) > 1]
+        if clashes:
+            parser.error("these files would write the same output, process them separately: " + "; ".join(clashes))
+    os.makedirs(arguments.output_dir, exist_ok=True)
+
+    if arguments.jobs > 1 and len(arguments.files) > 1:
+        with ProcessPoolExecutor(max_workers=arguments.jobs) as executor:
+            results = list(executor.map(run, arguments.files, [arguments] * len(arguments.files)))
+    else:
+        results = (run(filename, arguments) for filename in arguments.files)
+
+    failed = 0
+    for filename, problems, error in results:
+        for problem in problems:
+            print(f"{filename}: {problem}", file=sys.stderr)
+        if error is not None:
+            failed += 1
+            print(f"{filename}: failed: {error}", file=sys.stderr)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
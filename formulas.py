@@ -0,0 +1,581 @@
+"""Formula compiler used by the cells of a worksheet.
+
+The text of a formula (everything after the "=" sign) is tokenized and parsed
+into an expression tree once, and the tree is compiled into nested Python
+closures. Recalculating a cell then only needs the current values of the cells
+the formula references - no regex, no string substitution and no eval.
+
+Ranges such as A1:B5000 can be passed to the aggregate functions (SUM,
+AVERAGE, MIN, MAX, COUNT). A range is handed to the function as a single
+RangeArgument whose numbers come in batches straight from the column storage.
+
+Cells and ranges of other sheets are referenced with the sheet name and an
+exclamation mark: Sheet2!A1, Sheet2!A1:B10, or 'Sales 2024'!A1 when the
+name is not a plain identifier.
+
+The lookup functions VLOOKUP, MATCH and COUNTIF search a range through the
+lookup indexes of its columns (see RangeArgument) instead of scanning it.
+Text is written in double quotes: COUNTIF(A1:A100, ">5"), VLOOKUP("b", A1:B9, 2, FALSE).
+"""
+
+# Import packages
+from typing import *
+import re
+import math
+import operator
+from functools import lru_cache
+
+
+# Tokens of the formula language: numbers, text in double quotes, sheet
+# prefixes (Sheet2! or 'Sales 2024'!), names (cell references and function
+# names) and operators
+TOKEN_PATTERN = re.compile(r"""
+    \s*(?:
+        (?P<number>(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?)
+      | (?P<string>"(?:[^"]|"")*")
+      | (?P<sheet>(?:[A-Za-z_][A-Za-z0-9_.]*|'(?:[^']|'')+')!)
+      | (?P<name>[A-Za-z_][A-Za-z0-9_]*)
+      | (?P<operator>\*\*|//|<=|>=|==|!=|<>|[-+*/%(),<>:])
+    )""", re.VERBOSE)
+
+CELL_NAME_PATTERN = re.compile(r"[A-Za-z]+\d+")
+
+# Names of constants (case-insensitive)
+CONSTANTS = {"true": 1.0, "false": 0.0}
+
+# A COUNTIF criterion: an optional comparison operator and the value to compare with
+CRITERION_PATTERN = re.compile(r"(<=|>=|<>|=|<|>)?(.*)", re.DOTALL)
+
+
+def split_reference(reference: str) -> Tuple[str, str]:
+    """
+    Splits a reference of Formula.references into its sheet name ('' for the
+    sheet of the formula) and the cell or range name: 'Sheet2!A1:B5' gives
+    ('Sheet2', 'A1:B5').
+    """
+    sheet_name, _, name = reference.rpartition('!')
+    return sheet_name, name
+
+
+def _sheet_name(token: str) -> str:
+    """The sheet name of a sheet prefix token (Sheet2! or 'Sales 2024'!)."""
+    name = token[:-1]
+    if name.startswith("'"):
+        name = name[1:-1].replace("''", "'")
+    return name
+
+
+class RangeArgument:
+    """
+    A range of cells (e.g. A1:C1000) passed as an argument to a formula function.
+    """
+    __slots__ = ()
+
+    def number_batches(self) -> Iterator[Sequence[float]]:
+        """
+        Yields the numbers held in the range in batches (e.g. one batch per
+        stored column chunk). Empty cells and text are skipped.
+        """
+        raise NotImplementedError
+
+    # The lookup functions work with lookup keys (see lookup_key). For the
+    # match types, 0 finds a key equal to the given one, 1 the largest key not
+    # above it and -1 the smallest key not below it
+
+    def shape(self) -> Tuple[int, int]:
+        """The number of rows and columns of the range."""
+        raise NotImplementedError
+
+    def value_at(self, row: int, column: int) -> Any:
+        """The value (or the text of a text cell) at a position in the range, from 0."""
+        raise NotImplementedError
+
+    def find_in_column(self, key: Any, match_type: int) -> Optional[int]:
+        """The row (from 0) of the cell of the first column of the range matching the key."""
+        raise NotImplementedError
+
+    def find(self, key: Any, match_type: int) -> Optional[int]:
+        """The position (from 0) of the cell matching the key in a range of a single row or column."""
+        raise NotImplementedError
+
+    def count_if(self, operator_text: str, key: Any) -> int:
+        """The number of cells of the range whose key compares to the given key with the operator."""
+        raise NotImplementedError
+
+
+def lookup_key(value: Any) -> Any:
+    """
+    The key a value is looked up by: numbers as floats, text lower-cased (so
+    lookups ignore case), None for an empty value.
+    """
+    if value is None:
+        return None
+    if isinstance(value, str):
+        return value.lower()
+    return float(value)
+
+
+def match_position(keys: Sequence[Any], key: Any, match_type: int) -> Optional[int]:
+    """
+    The position in the keys of the one matching the key, keys of a different
+    kind (number or text) are skipped. Used where a range has no index, e.g.
+    along a row.
+    """
+    best = None
+    for position, candidate in enumerate(keys):
+        if candidate is None or isinstance(candidate, str) != isinstance(key, str):
+            continue
+        if match_type == 0:
+            if candidate == key:
+                return position
+        elif match_type > 0:
+            if candidate <= key and (best is None or candidate >= keys[best]):
+                best = position
+        elif candidate >= key and (best is None or candidate < keys[best]):
+            best = position
+    return best
+
+
+def parse_criterion(criterion: Any) -> Tuple[str, Any]:
+    """
+    Splits a COUNTIF criterion into an operator and a lookup key: 5 gives
+    ('=', 5.0), ">=10" gives ('>=', 10.0) and "apple" gives ('=', 'apple').
+    """
+    if not isinstance(criterion, str):
+        return '=', lookup_key(criterion)
+    operator_text, operand = CRITERION_PATTERN.fullmatch(criterion).groups()
+    try:
+        key = float(operand)
+    except ValueError:
+        key = operand.lower()
+    return operator_text or '=', key
+
+
+def number_batches(arguments: Sequence[Any]) -> List[Sequence[float]]:
+    """
+    Collect the numbers of plain and range arguments as a list of batches.
+    Arguments that are not numbers (empty cells, text) are skipped, as in ranges.
+    """
+    batches = []
+    scalars = []
+    for argument in arguments:
+        if isinstance(argument, RangeArgument):
+            batches.extend(batch for batch in argument.number_batches() if len(batch))
+        elif isinstance(argument, (int, float)):
+            scalars.append(argument)
+    if scalars:
+        batches.append(scalars)
+    return batches
+
+
+# Aggregate functions reduce every batch with a builtin (running in C over the
+# array of the batch) and then combine the partial results
+
+
+def _average(batches: List[Sequence[float]]) -> float:
+    count = sum(map(len, batches))
+    if count == 0:
+        raise ZeroDivisionError("average of no values")
+    return sum(map(sum, batches)) / count
+
+
+AGGREGATES: Dict[str, Callable[[List[Sequence[float]]], float]] = {
+    "sum": lambda batches: sum(map(sum, batches)),
+    "average": _average,
+    "min": lambda batches: min(map(min, batches), default=0.0),
+    "max": lambda batches: max(map(max, batches), default=0.0),
+    "count": lambda batches: float(sum(map(len, batches))),
+}
+
+
+def aggregate(name: str) -> Callable[..., float]:
+    """Returns the formula function applying an aggregate to its arguments."""
+    reduce = AGGREGATES[name]
+    return lambda *arguments: reduce(number_batches(arguments))
+
+
+# Lookup functions
+
+def _range_argument(argument: Any, function_name: str) -> RangeArgument:
+    if not isinstance(argument, RangeArgument):
+        raise ValueError(f"{function_name} expects a range of cells")
+    return argument
+
+
+def vlookup(key: Any, table: Any, column: float, approximate: float = 1.0) -> Any:
+    """
+    The value in the given column (from 1) of the table on the row whose first
+    column matches the key: exactly, or the largest key not above it when
+    approximate (the default, the first column is expected to be sorted).
+    """
+    table = _range_argument(table, "VLOOKUP")
+    column = int(column)
+    if not 1 <= column <= table.shape()[1]:
+        raise ValueError(f"VLOOKUP column {column} is outside the table")
+    row = table.find_in_column(lookup_key(key), 1 if approximate else 0)
+    if row is None:
+        raise ValueError(f"VLOOKUP did not find {key!r}")
+    return table.value_at(row, column - 1)
+
+
+def match(key: Any, cells: Any, match_type: float = 1.0) -> float:
+    """The position (from 1) of the cell matching the key in a row or column of cells."""
+    cells = _range_argument(cells, "MATCH")
+    position = cells.find(lookup_key(key), int(match_type))
+    if position is None:
+        raise ValueError(f"MATCH did not find {key!r}")
+    return float(position + 1)
+
+
+def countif(cells: Any, criterion: Any) -> float:
+    """The number of cells matching the criterion, e.g. 5, ">5" or "apple"."""
+    operator_text, key = parse_criterion(criterion)
+    return float(_range_argument(cells, "COUNTIF").count_if(operator_text, key))
+
+
+# Results of every memoized function kept for this many distinct arguments
+FUNCTION_CACHE_SIZE = 4096
+
+
+class FormulaFunction:
+    """
+    A function that can be called from formulas. A pure function (its result
+    depends only on its argument values) can be memoized: calls with plain
+    values go through a bounded LRU cache of its results, calls with a range
+    argument always run the function since the cells of the range can change.
+    """
+    __slots__ = ('name', 'function', 'cached')
+
+    def __init__(self, name: str, function: Callable, memoize: bool = False,
+                 cache_size: int = FUNCTION_CACHE_SIZE) -> None:
+        self.name = name
+        self.function = function
+        # typed, so that e.g. round(2) and round(2.0) are cached apart
+        self.cached = lru_cache(maxsize=cache_size, typed=True)(function) if memoize else None
+
+    def cache_info(self):
+        """Hits, misses, maximum and current size of the cache, None if not memoized."""
+        return None if self.cached is None else self.cached.cache_info()
+
+    def cache_clear(self) -> None:
+        if self.cached is not None:
+            self.cached.cache_clear()
+
+
+# Functions that can be called from a formula by name (case-insensitive)
+FUNCTIONS: Dict[str, FormulaFunction] = {}
+
+
+def register_function(name: str, function: Callable, memoize: bool = False,
+                      cache_size: int = FUNCTION_CACHE_SIZE) -> FormulaFunction:
+    """
+    Makes a function callable from formulas, replacing any function with the
+    same name. Formulas compiled before keep the function they were compiled with.
+    """
+    formula_function = FormulaFunction(name.lower(), function, memoize, cache_size)
+    FUNCTIONS[formula_function.name] = formula_function
+    return formula_function
+
+
+def function_cache_info() -> Dict[str, Any]:
+    """The cache statistics of the memoized functions, by name."""
+    return {name: function.cache_info() for name, function in FUNCTIONS.items() if function.cached is not None}
+
+
+def clear_function_caches() -> None:
+    for function in FUNCTIONS.values():
+        function.cache_clear()
+
+
+register_function("sqrt", math.sqrt, memoize=True)
+register_function("pow", math.pow, memoize=True)
+register_function("abs", abs, memoize=True)
+register_function("round", round, memoize=True)
+register_function("min", aggregate("min"), memoize=True)
+register_function("max", aggregate("max"), memoize=True)
+register_function("sum", aggregate("sum"), memoize=True)
+register_function("average", aggregate("average"), memoize=True)
+register_function("count", aggregate("count"), memoize=True)
+# the lookups read ranges, their results are never cached
+register_function("vlookup", vlookup)
+register_function("match", match)
+register_function("countif", countif)
+
+BINARY_OPERATORS: Dict[str, Callable[[Any, Any], Any]] = {
+    "+": operator.add,
+    "-": operator.sub,
+    "*": operator.mul,
+    "/": operator.truediv,
+    "//": operator.floordiv,
+    "%": operator.mod,
+    "**": operator.pow,
+    "<": operator.lt,
+    ">": operator.gt,
+    "<=": operator.le,
+    ">=": operator.ge,
+    "==": operator.eq,
+    "!=": operator.ne,
+    "<>": operator.ne,
+}
+
+UNARY_OPERATORS: Dict[str, Callable[[Any], Any]] = {
+    "+": operator.pos,
+    "-": operator.neg,
+}
+
+COMPARISON_OPERATORS = ("<", ">", "<=", ">=", "==", "!=", "<>")
+
+
+class Formula:
+    """
+    A compiled formula. `references` lists the names of the cells (e.g. 'A1')
+    and ranges (e.g. 'A1:B5') the formula reads, upper-cased, each name once,
+    in order of first appearance. References to other sheets keep the sheet
+    name as written (e.g. 'Sheet2!A1', see split_reference). `evaluate` expects the current values of the
+    cells (None for an empty cell) and a RangeArgument for each range in that same order.
+    """
+    __slots__ = ('text', 'references', '_evaluate')
+
+    def __init__(self, text: str, references: Tuple[str, ...], evaluate: Callable[[Sequence], Any]) -> None:
+        self.text = text
+        self.references = references
+        self._evaluate = evaluate
+
+    @property
+    def expression(self) -> str:
+        return self.text[1:]
+
+    def evaluate(self, values: Sequence) -> Any:
+        """
+        Evaluates the formula with the given values of the referenced cells.
+        """
+        return self._evaluate(values)
+
+
+def tokenize(expression: str) -> List[Tuple[str, str]]:
+    """Split a formula expression into (kind, text) tokens."""
+    tokens = []
+    position = 0
+    expression = expression.rstrip()
+    while position < len(expression):
+        match = TOKEN_PATTERN.match(expression, position)
+        if not match or match.end() == position:
+            raise ValueError(f"Unexpected character '{expression[position:].strip()[:1]}' in expression '{expression}'")
+        kind = match.lastgroup
+        tokens.append((kind, match.group(kind)))
+        position = match.end()
+    return tokens
+
+
+class _Parser:
+    """
+    Recursive descent parser building the expression tree of a formula.
+    Nodes are tuples: ('number', value), ('string', text), ('reference', index), ('range', index),
+    ('unary', operator, operand), ('binary', operator, left, right) and
+    ('call', function name, arguments).
+    """
+
+    def __init__(self, expression: str) -> None:
+        self.expression = expression
+        self.tokens = tokenize(expression)
+        self.position = 0
+        self.references: List[str] = []
+
+    def peek(self) -> Optional[str]:
+        if self.position < len(self.tokens):
+            return self.tokens[self.position][1]
+        return None
+
+    def next(self) -> Tuple[str, str]:
+        if self.position >= len(self.tokens):
+            raise ValueError(f"Unexpected end of expression '{self.expression}'")
+        token = self.tokens[self.position]
+        self.position += 1
+        return token
+
+    def expect(self, text: str) -> None:
+        kind, token = self.next()
+        if token != text:
+            raise ValueError(f"Expected '{text}' but found '{token}' in expression '{self.expression}'")
+
+    def parse(self) -> tuple:
+        if not self.tokens:
+            raise ValueError("Empty expression")
+        node = self.parse_comparison()
+        if self.position < len(self.tokens):
+            raise ValueError(f"Unexpected '{self.peek()}' in expression '{self.expression}'")
+        return node
+
+    def parse_comparison(self) -> tuple:
+        node = self.parse_sum()
+        while self.peek() in COMPARISON_OPERATORS:
+            operator_text = self.next()[1]
+            node = ('binary', operator_text, node, self.parse_sum())
+        return node
+
+    def parse_sum(self) -> tuple:
+        node = self.parse_product()
+        while self.peek() in ('+', '-'):
+            operator_text = self.next()[1]
+            node = ('binary', operator_text, node, self.parse_product())
+        return node
+
+    def parse_product(self) -> tuple:
+        node = self.parse_unary()
+        while self.peek() in ('*', '/', '//', '%'):
+            operator_text = self.next()[1]
+            node = ('binary', operator_text, node, self.parse_unary())
+        return node
+
+    def parse_unary(self) -> tuple:
+        if self.peek() in ('+', '-'):
+            operator_text = self.next()[1]
+            return ('unary', operator_text, self.parse_unary())
+        return self.parse_power()
+
+    def parse_power(self) -> tuple:
+        node = self.parse_primary()
+        if self.peek() == '**':
+            self.next()
+            # right associative, and the exponent may carry its own sign (2 ** -1)
+            node = ('binary', '**', node, self.parse_unary())
+        return node
+
+    def parse_primary(self) -> tuple:
+        kind, token = self.next()
+        if kind == 'number':
+            return ('number', float(token))
+        if kind == 'string':
+            return ('string', token[1:-1].replace('""', '"'))
+        if kind == 'sheet':
+            name_kind, name = self.next()
+            if name_kind != 'name' or not CELL_NAME_PATTERN.fullmatch(name):
+                raise ValueError(f"Expected a cell after '{token}' in expression '{self.expression}'")
+            return ('reference', self.reference_index(f"{_sheet_name(token)}!{name.upper()}"))
+        if kind == 'name':
+            if self.peek() == '(':
+                return self.parse_call(token)
+            if CELL_NAME_PATTERN.fullmatch(token):
+                return ('reference', self.reference_index(token.upper()))
+            if token.lower() in CONSTANTS:
+                return ('number', CONSTANTS[token.lower()])
+            raise ValueError(f"Unknown name '{token}' in expression '{self.expression}'")
+        if token == '(':
+            node = self.parse_comparison()
+            self.expect(')')
+            return node
+        raise ValueError(f"Unexpected '{token}' in expression '{self.expression}'")
+
+    def parse_call(self, name: str) -> tuple:
+        if name.lower() not in FUNCTIONS:
+            raise ValueError(f"Unknown function '{name}' in expression '{self.expression}'")
+        self.expect('(')
+        arguments = []
+        if self.peek() != ')':
+            arguments.append(self.parse_argument())
+            while self.peek() == ',':
+                self.next()
+                arguments.append(self.parse_argument())
+        self.expect(')')
+        return ('call', name.lower(), tuple(arguments))
+
+    def parse_argument(self) -> tuple:
+        # A range (e.g. A1:B5 or Sheet2!A1:B5) can only be used as a whole
+        # function argument
+        start = self.position
+        prefix = ''
+        if start < len(self.tokens) and self.tokens[start][0] == 'sheet':
+            prefix = _sheet_name(self.tokens[start][1]) + '!'
+            start += 1
+        tokens = self.tokens[start:start + 4]
+        if (len(tokens) == 4 and tokens[1][1] == ':' and tokens[3][1] in (',', ')')
+                and CELL_NAME_PATTERN.fullmatch(tokens[0][1]) and CELL_NAME_PATTERN.fullmatch(tokens[2][1])):
+            self.position = start + 3
+            range_name = f"{tokens[0][1]}:{tokens[2][1]}".upper()
+            return ('range', self.reference_index(prefix + range_name))
+        return self.parse_comparison()
+
+    def reference_index(self, cell_name: str) -> int:
+        if cell_name not in self.references:
+            self.references.append(cell_name)
+        return self.references.index(cell_name)
+
+
+def _constant(value: Any) -> Callable[[Sequence], Any]:
+    compiled = lambda values: value
+    compiled.constant = value
+    return compiled
+
+
+def _is_constant(compiled: Callable) -> bool:
+    return hasattr(compiled, 'constant')
+
+
+def _reference(index: int) -> Callable[[Sequence], Any]:
+    # an empty cell reads as 0 in expressions
+    return lambda values: 0 if values[index] is None else values[index]
+
+
+def _compile_node(node: tuple) -> Callable[[Sequence], Any]:
+    """Turn an expression tree node into a closure taking the referenced values."""
+    kind = node[0]
+    if kind in ('number', 'string'):
+        return _constant(node[1])
+    if kind == 'reference':
+        return _reference(node[1])
+    if kind == 'range':
+        return operator.itemgetter(node[1])
+    if kind == 'unary':
+        function = UNARY_OPERATORS[node[1]]
+        operand = _compile_node(node[2])
+        if _is_constant(operand):
+            try:
+                return _constant(function(operand.constant))
+            except (ArithmeticError, TypeError, ValueError):
+                pass  # leave the error to be reported when the formula is evaluated
+        return lambda values: function(operand(values))
+    if kind == 'binary':
+        function = BINARY_OPERATORS[node[1]]
+        left = _compile_node(node[2])
+        right = _compile_node(node[3])
+        if _is_constant(left) and _is_constant(right):
+            try:
+                return _constant(function(left.constant, right.constant))
+            except (ArithmeticError, TypeError, ValueError):
+                pass  # leave the error to be reported when the formula is evaluated
+        return lambda values: function(left(values), right(values))
+    if kind == 'call':
+        formula_function = FUNCTIONS[node[1]]
+        # the arguments of a call without ranges are plain values, the results
+        # can come from the cache of a memoized function
+        if formula_function.cached is not None and all(argument[0] != 'range' for argument in node[2]):
+            function = formula_function.cached
+        else:
+            function = formula_function.function
+        # an aggregate sees a cell given directly as it is, so that like the
+        # cells of a range an empty or text cell is not counted as a number
+        arguments = [operator.itemgetter(argument[1]) if argument[0] == 'reference' and node[1] in AGGREGATES
+                     else _compile_node(argument) for argument in node[2]]
+        if len(arguments) == 1:
+            argument = arguments[0]
+            return lambda values: function(argument(values))
+        if len(arguments) == 2:
+            first, second = arguments
+            return lambda values: function(first(values), second(values))
+        return lambda values: function(*[argument(values) for argument in arguments])
+    raise ValueError(f"Unknown expression node '{kind}'")
+
+
+def compile_formula(text: str) -> Formula:
+    """
+    Compiles the text of a formula cell (e.g. "=A1 + sqrt(B2)") into a Formula.
+    Raises ValueError if the formula is not valid.
+    """
+    if not text or not text.startswith('='):
+        raise ValueError(f"'{text}' is not a formula")
+    parser = _Parser(text[1:])
+    try:
+        tree = parser.parse()
+        return Formula(text, tuple(parser.references), _compile_node(tree))
+    except RecursionError:
+        raise ValueError(f"Expression '{text[1:]}' is nested too deeply") from None
@@ -1,19 +1,46 @@
 import tkinter as tk
 from tkinter import filedialog, simpledialog, messagebox, ttk
-import json
+from concurrent.futures import ThreadPoolExecutor
 from classes import *
 
+# Only this many rows and columns of Entry widgets are created, scrolling moves
+# them over the worksheet
+VISIBLE_ROWS = 20
+VISIBLE_COLUMNS = 10
+# How often (ms) the window checks on a recalculation running in the background
+POLL_INTERVAL = 50
+# Shown in place of the value of a cell that is waiting to be recalculated
+CALCULATING_TEXT = "..."
+
 
 class SpreadsheetApp(tk.Tk):
     def __init__(self):
         super().__init__()
         self.notebook = None
         self.file_menu = None
+        self.edit_menu = None
         self.menu_bar = None
         self.title("Spreadsheet App")
         self.workbook = Workbook()  # משתמש במחלקה הקיימת
         self.current_sheet_name = None
-        self.entries = {}  # Dictionary to hold Entry widgets
+        self.entries = {}  # Dictionary to hold Entry widgets, by position in the viewport
+        self.row_headers = []
+        self.column_headers = []
+        self.vertical_scrollbar = None
+        self.horizontal_scrollbar = None
+        # Worksheet position of the top-left entry of the viewport
+        self.top_row = 0
+        self.left_column = 0
+        # (row, column, entry) of the cell being edited
+        self.editing = None
+        # Recalculations run on a single worker thread so the window stays
+        # responsive, a new edit cancels the job still running
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.job = None
+        self.job_future = None
+        # Cells shown as calculating until the job recalculating them finishes
+        self.calculating = set()
+        self.protocol("WM_DELETE_WINDOW", self.close)
         self.setup_menus()
         self.sheet_frame = None
         self.setup_notebook()  # קריאה להגדרת ה-notebook
@@ -39,53 +66,216 @@ class SpreadsheetApp(tk.Tk):
         self.file_menu.add_command(label="Save Workbook As...", command=self.save_workbook_as)
         self.menu_bar.add_cascade(label="File", menu=self.file_menu)
 
-    def create_grid(self, rows=10, columns=10):
+        self.edit_menu = tk.Menu(self.menu_bar, tearoff=0)
+        self.edit_menu.add_command(label="Undo", accelerator="Ctrl+Z", command=lambda: self.replay(self.workbook.undo))
+        self.edit_menu.add_command(label="Redo", accelerator="Ctrl+Y", command=lambda: self.replay(self.workbook.redo))
+        self.menu_bar.add_cascade(label="Edit", menu=self.edit_menu)
+        self.bind_all('<Control-z>', lambda e: self.replay(self.workbook.undo))
+        self.bind_all('<Control-y>', lambda e: self.replay(self.workbook.redo))
+
+    def create_grid(self):
         if self.sheet_frame:
             self.sheet_frame.destroy()
+        sheet = self.workbook.get_sheet(self.current_sheet_name)
+        rows = min(VISIBLE_ROWS, sheet.num_rows)
+        columns = min(VISIBLE_COLUMNS, sheet.num_columns)
+        self.top_row = 0
+        self.left_column = 0
+        self.editing = None
+        self.entries = {}
+        self.row_headers = []
+        self.column_headers = []
+
         self.sheet_frame = tk.Frame(self)
         self.sheet_frame.pack(fill=tk.BOTH, expand=True)
         title_label = tk.Label(self.sheet_frame, text=f"Current Sheet: {self.current_sheet_name}")
-        title_label.grid(row=0, column=0, columnspan=columns, sticky="ew")
+        title_label.grid(row=0, column=0, columnspan=columns + 1, sticky="ew")
 
         for j in range(columns):
-            col_header = tk.Label(self.sheet_frame, text=chr(65 + j))  # Headers A, B, C, etc.
+            col_header = tk.Label(self.sheet_frame)  # Headers A, B, C, etc., set by refresh_ui
             col_header.grid(row=1, column=j + 1)
+            self.column_headers.append(col_header)
 
         for i in range(rows):
-            row_header = tk.Label(self.sheet_frame, text=str(i + 1))  # Row numbers 1, 2, 3, etc.
+            row_header = tk.Label(self.sheet_frame)  # Row numbers 1, 2, 3, etc., set by refresh_ui
             row_header.grid(row=i + 2, column=0)
+            self.row_headers.append(row_header)
 
             for j in range(columns):
                 entry = tk.Entry(self.sheet_frame, width=10)
                 entry.grid(row=i + 2, column=j + 1)
+                entry.bind('<FocusIn>', lambda e, r=i, c=j: self.cell_focused(r, c, e.widget))
                 entry.bind('<FocusOut>',
                            lambda e, r=i, c=j: self.cell_updated(r, c, e.widget))  # Bind for updating cell values
 
                 self.entries[(i, j)] = entry
 
+        self.vertical_scrollbar = tk.Scrollbar(self.sheet_frame, orient=tk.VERTICAL, command=self.scroll_rows)
+        self.vertical_scrollbar.grid(row=2, column=columns + 1, rowspan=rows, sticky="ns")
+        self.horizontal_scrollbar = tk.Scrollbar(self.sheet_frame, orient=tk.HORIZONTAL, command=self.scroll_columns)
+        self.horizontal_scrollbar.grid(row=rows + 2, column=1, columnspan=columns, sticky="ew")
+        self.bind_all('<MouseWheel>', self.on_mouse_wheel)
+        self.bind_all('<Button-4>', self.on_mouse_wheel)
+        self.bind_all('<Button-5>', self.on_mouse_wheel)
+        self.refresh_ui()
+
+    def cell_focused(self, row, col, widget):
+        # Show the text of the cell (e.g. its formula) while it is edited
+        sheet = self.workbook.get_sheet(self.current_sheet_name)
+        sheet_row, sheet_column = self.top_row + row, self.left_column + col
+        self.editing = (sheet_row, sheet_column, widget)
+        widget.delete(0, tk.END)
+        widget.insert(0, sheet.get_cell_text(sheet_row, sheet_column) or "")
+
     def cell_updated(self, row, col, widget):
+        if self.editing is None or self.editing[2] is not widget:
+            return
+        sheet_row, sheet_column, _ = self.editing
+        self.editing = None
         text = widget.get()
         sheet = self.workbook.get_sheet(self.current_sheet_name)
-        cell = sheet.get_cell(row, col)
-        cell.insert_text(text)
+        cell = sheet.get_cell(sheet_row, sheet_column)
+        if text == (cell.text or ""):
+            self.refresh_cells([cell])
+            return
+        # Cells the cancelled job did not get to are recalculated by the new one
+        remaining = self.cancel_recalculation()
+        try:
+            with self.workbook.engine.lock:
+                cell.insert_text(text, recalculate=False)
+        except ValueError as e:
+            messagebox.showerror("Error", str(e))
+        self.start_recalculation(remaining + [cell])
+
+    def replay(self, action):
+        """Runs Workbook.undo or redo, after committing the edit in progress."""
+        if self.current_sheet_name is None:
+            return
+        self.commit_edit()
+        # like an edit, the texts are written back on this thread and the
+        # cells recalculated in the background, with the cells a cancelled
+        # job did not get to
+        remaining = self.cancel_recalculation()
+        with self.workbook.engine.lock:
+            written = action(recalculate=False)
+        if remaining or written:
+            self.start_recalculation(remaining + written)
         self.refresh_ui()
 
+    def cancel_recalculation(self):
+        """Cancels the running job, returns the cells it did not recalculate."""
+        if self.job is None:
+            return []
+        self.job.cancel()
+        self.job_future.result()
+        remaining = self.job.remaining
+        self.job = self.job_future = None
+        return remaining
+
+    def start_recalculation(self, cells):
+        self.job = RecalcJob(self.workbook.engine, cells)
+        self.job_future = self.executor.submit(self.job.run)
+        self.after(POLL_INTERVAL, self.poll_recalculation, self.job)
+
+    def poll_recalculation(self, job):
+        if job is not self.job:
+            return  # cancelled, a newer job is polled instead
+        if not self.job_future.done():
+            # show the cells still waiting as calculating
+            waiting = [cell for cell in job.pending if cell not in self.calculating]
+            self.calculating.update(waiting)
+            self.refresh_cells(waiting)
+            self.after(POLL_INTERVAL, self.poll_recalculation, job)
+            return
+        self.job = self.job_future = None
+        # Only the cells the recalculation changed are redrawn
+        changed = list(self.calculating.union(job.recalculated))
+        self.calculating.clear()
+        self.refresh_cells(changed)
+        if job.error is not None:
+            messagebox.showerror("Error", str(job.error))
+            self.refresh_ui()
+
+    def display_value(self, cell):
+        return CALCULATING_TEXT if cell in self.calculating else cell.get_display_value()
+
+    def close(self):
+        self.cancel_recalculation()
+        self.executor.shutdown()
+        self.destroy()
 
     def show_formula(self, row, col, widget):
         cell = self.workbook.get_sheet(self.current_sheet_name).get_cell(row, col)
         # Debug output to verify the cell's status
-        print(f"Checking cell at row {row}, col {col}: formula={cell.formula}, value={cell.value}")
+        print(f"Checking cell at row {row}, col {col}: formula={cell.text}, value={cell.value}")
         if cell.formula:
-            messagebox.showinfo("Formula", f"Formula in cell {chr(65 + col)}{row + 1}: {cell.formula}")
+            messagebox.showinfo("Formula", f"Formula in cell {cell.get_name()}: {cell.text}")
         else:
             messagebox.showinfo("Formula", "No formula defined for this cell.")
 
+    def refresh_cells(self, cells):
+        """Redraws the entries of the given cells that are inside the viewport."""
+        sheet = self.workbook.get_sheet(self.current_sheet_name)
+        for cell in cells:
+            if cell.owner_worksheet is not sheet:
+                continue
+            entry = self.entries.get((cell.row - self.top_row, cell.column - self.left_column))
+            if entry is not None and (self.editing is None or self.editing[2] is not entry):
+                entry.delete(0, tk.END)
+                entry.insert(0, self.display_value(cell))
+
     def refresh_ui(self):
+        """Redraws the whole viewport: headers, entries and scrollbars."""
         sheet = self.workbook.get_sheet(self.current_sheet_name)
+        for j, col_header in enumerate(self.column_headers):
+            col_header.config(text=column_index_to_letter(self.left_column + j))
+        for i, row_header in enumerate(self.row_headers):
+            row_header.config(text=str(self.top_row + i + 1))
         for (row, col), entry in self.entries.items():
-            cell = sheet.get_cell(row, col)
+            if self.editing is not None and self.editing[2] is entry:
+                continue
             entry.delete(0, tk.END)
-            entry.insert(0, cell.get_display_value())
+            entry.insert(0, self.display_value(sheet.get_cell(self.top_row + row, self.left_column + col)))
+        if self.vertical_scrollbar:
+            self.vertical_scrollbar.set(self.top_row / sheet.num_rows,
+                                        (self.top_row + len(self.row_headers)) / sheet.num_rows)
+            self.horizontal_scrollbar.set(self.left_column / sheet.num_columns,
+                                          (self.left_column + len(self.column_headers)) / sheet.num_columns)
+
+    @staticmethod
+    def scroll_position(position, total, visible, action, amount, unit=None):
+        """New first visible row/column for a scrollbar command."""
+        if action == 'moveto':
+            position = int(float(amount) * total)
+        else:
+            position += int(amount) * (visible if unit == 'pages' else 1)
+        return max(0, min(position, total - visible))
+
+    def commit_edit(self):
+        # An edit in progress belongs to the cell it started on, commit it
+        # before the viewport moves
+        if self.editing is not None:
+            sheet_row, sheet_column, widget = self.editing
+            self.cell_updated(sheet_row - self.top_row, sheet_column - self.left_column, widget)
+            self.focus_set()
+
+    def scroll_rows(self, *command):
+        self.commit_edit()
+        sheet = self.workbook.get_sheet(self.current_sheet_name)
+        self.top_row = self.scroll_position(self.top_row, sheet.num_rows, len(self.row_headers), *command)
+        self.refresh_ui()
+
+    def scroll_columns(self, *command):
+        self.commit_edit()
+        sheet = self.workbook.get_sheet(self.current_sheet_name)
+        self.left_column = self.scroll_position(self.left_column, sheet.num_columns, len(self.column_headers), *command)
+        self.refresh_ui()
+
+    def on_mouse_wheel(self, event):
+        if self.current_sheet_name is None:
+            return
+        step = -1 if event.num == 4 or event.delta > 0 else 1
+        self.scroll_rows('scroll', step, 'units')
 
     def create_new_sheet(self):
         new_sheet_name = simpledialog.askstring("New Sheet", "Enter the name of the new sheet:")
@@ -95,16 +285,17 @@ class SpreadsheetApp(tk.Tk):
             self.create_grid()
 
     def open_workbook(self):
-        file_path = filedialog.askopenfilename(filetypes=[("JSON files", "*.json"), ("All files", "*.*")])
+        file_path = filedialog.askopenfilename(filetypes=[("JSON files", "*.json"),
+                                                          ("Binary workbooks", f"*{BINARY_EXTENSION}"),
+                                                          ("All files", "*.*")])
         if file_path:
-            with open(file_path, 'r') as file:
-                data = json.load(file)
-                self.workbook.load_from_json(data)  # טעינת הנתונים למחלקת Workbook
-                self.current_sheet_name = next(iter(self.workbook.sheets))  # בחירת הדף הראשון להצגה
-                print(self.workbook.sheets[self.current_sheet_name].table[0][0].text)
+            self.cancel_recalculation()
+            self.calculating.clear()
+            self.workbook.load_from_file(file_path)  # טעינת הנתונים למחלקת Workbook
+            self.workbook.journal.clear()  # the edits of the sheets replaced cannot be undone
+            self.current_sheet_name = next(iter(self.workbook.sheets))  # בחירת הדף הראשון להצגה
 
-                self.create_grid()  # יצירת הגריד עם הנתונים החדשים
-                self.refresh_ui()
+            self.create_grid()  # יצירת הגריד עם הנתונים החדשים
 
 
     def save_workbook(self):
@@ -113,9 +304,10 @@ class SpreadsheetApp(tk.Tk):
             self.save_workbook_as(file_path)
 
     def save_workbook_as(self, file_path):
-        with open(file_path, 'w') as file:
-            json.dump(self.workbook.to_json(), file)
-            print("Workbook saved.")
+        if file_path.endswith(BINARY_EXTENSION):
+            save_workbook_binary(self.workbook, file_path)
+        else:
+            save_workbook_as(self.workbook, file_path)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,281 @@
+"""Tests of recalculation, cycles, ranges, sheets and undo."""
+
+# Import packages
+import tracemalloc
+import pytest
+from classes import (CHUNK_SIZE, CircularReferenceError, Journal, RecalcEngine, RecalcJob, Workbook, Worksheet,
+                     column_index_to_letter, parse_cell_name)
+
+
+def sheet(rows=10, columns=5):
+    return Worksheet(rows=rows, columns=columns)
+
+
+def test_chain_and_diamond_are_recalculated_once_per_cell():
+    worksheet = sheet()
+    worksheet.set_cell_value(0, 0, 1)
+    worksheet.set_cell_value(0, 1, "=A1 + 1")
+    worksheet.set_cell_value(0, 2, "=A1 * 2")
+    worksheet.set_cell_value(0, 3, "=B1 + C1")
+    recalculated = worksheet.get_cell(0, 0).insert_text("10")
+    assert [cell.get_name() for cell in recalculated].count("D1") == 1
+    assert recalculated[-1].get_name() == "D1"
+    assert worksheet.get_cell_value(0, 3) == 31.0
+
+
+def test_cycle_is_reported_and_cells_outside_it_are_recalculated():
+    worksheet = sheet()
+    worksheet.set_cell_value(0, 0, "=B1 + 1")
+    with pytest.raises(CircularReferenceError) as error:
+        worksheet.set_cell_value(0, 1, "=A1 + 1")
+    assert {cell.get_name() for cell in error.value.cells} == {"A1", "B1"}
+    assert worksheet.get_cell_value(0, 0) is None
+    assert worksheet.get_cell_value(0, 1) is None
+
+    # breaking the cycle recalculates both cells
+    worksheet.set_cell_value(0, 1, 5)
+    assert worksheet.get_cell_value(0, 0) == 6.0
+
+
+def test_self_reference_through_a_range_is_a_cycle():
+    worksheet = sheet()
+    worksheet.set_range(0, 0, [[1], [2]])
+    with pytest.raises(CircularReferenceError):
+        worksheet.set_cell_value(2, 0, "=SUM(A1:A4)")
+    assert worksheet.get_cell_value(2, 0) is None
+
+
+def test_invalid_formula_in_set_range_does_not_stop_the_others():
+    worksheet = sheet()
+    with pytest.raises(ValueError):
+        worksheet.set_range(0, 0, [[1, '="x"+1', "=A1*2"]])
+    assert worksheet.get_cell_value(0, 2) == 2.0
+    assert worksheet.get_cell(0, 2).formula is not None
+
+
+def test_range_formulas_follow_edits_across_row_blocks():
+    rows = CHUNK_SIZE * 3
+    worksheet = sheet(rows=rows, columns=3)
+    worksheet.set_range(0, 0, [[1] for _ in range(rows)])
+    worksheet.set_range(0, 1, [[f"=SUM(A1:A{rows})"], [f"=SUM(A{CHUNK_SIZE + 1}:A{CHUNK_SIZE + 2})"]])
+    assert worksheet.get_cell_value(0, 1) == rows
+    assert worksheet.get_cell_value(1, 1) == 2
+
+    worksheet.set_cell_value(CHUNK_SIZE, 0, 11)
+    assert worksheet.get_cell_value(0, 1) == rows + 10
+    assert worksheet.get_cell_value(1, 1) == 12
+    worksheet.set_cell_value(rows - 1, 0, 0)
+    assert worksheet.get_cell_value(0, 1) == rows + 9
+    assert worksheet.get_cell_value(1, 1) == 12
+
+    # a formula that no longer uses the range is not recalculated by it
+    worksheet.set_cell_value(1, 1, 7)
+    worksheet.set_cell_value(CHUNK_SIZE, 0, 1)
+    assert worksheet.get_cell_value(1, 1) == 7
+    subscribed = {cell.get_name() for subscribers in worksheet.range_subscribers[0].values()
+                  for _, cell in subscribers}
+    assert subscribed == {"B1"}
+
+
+def test_count_of_cells_given_directly_ignores_empty_and_text_cells():
+    worksheet = sheet()
+    worksheet.set_cell_value(4, 0, "text")
+    worksheet.set_cell_value(0, 1, "=COUNT(A1, A2, A3:A5)")
+    assert worksheet.get_cell_value(0, 1) == 0
+    worksheet.set_cell_value(1, 0, 3)
+    assert worksheet.get_cell_value(0, 1) == 1
+
+
+def test_references_to_other_sheets_follow_add_rename_and_remove():
+    workbook = Workbook()
+    workbook.add_sheet("Main")
+    main = workbook.get_sheet("Main")
+    with pytest.raises(ValueError):
+        main.set_cell_value(0, 0, "=Data!A1 + 1")
+    assert main.get_cell_value(0, 0) is None
+
+    workbook.add_sheet("Data")
+    workbook.get_sheet("Data").set_cell_value(0, 0, 41)
+    assert main.get_cell_value(0, 0) == 42.0
+
+    workbook.rename_sheet("Data", "Other")
+    assert main.get_cell_value(0, 0) is None
+    workbook.rename_sheet("Other", "Data")
+    assert main.get_cell_value(0, 0) == 42.0
+
+    workbook.remove_sheet("Data")
+    assert main.get_cell_value(0, 0) is None
+
+
+def test_removed_sheet_stops_waiting_for_missing_sheets():
+    workbook = Workbook()
+    workbook.add_sheet("A")
+    removed = workbook.get_sheet("A")
+    with pytest.raises(ValueError):
+        removed.set_cell_value(0, 0, "=Missing!A1 + 1")
+    workbook.remove_sheet("A")
+    assert not workbook.engine.unresolved
+
+    workbook.add_sheet("Missing")
+    workbook.get_sheet("Missing").set_cell_value(0, 0, 5)
+    assert removed.get_cell_value(0, 0) is None
+    assert removed.get_cell(0, 0).formula is None
+    assert not workbook.get_sheet("Missing").dependent_cells()
+
+
+def test_undo_and_redo():
+    workbook = Workbook()
+    workbook.add_sheet("S")
+    worksheet = workbook.get_sheet("S")
+    worksheet.set_cell_value(0, 0, 1)
+    worksheet.set_cell_value(0, 1, "=A1 * 10")
+    worksheet.set_range(0, 0, [[2], [3]])
+    assert worksheet.get_cell_value(0, 1) == 20.0
+
+    workbook.undo()
+    assert worksheet.get_cell_value(0, 1) == 10.0
+    assert worksheet.get_cell_text(1, 0) is None
+    workbook.undo()
+    assert worksheet.get_cell_text(0, 1) is None
+    workbook.redo()
+    workbook.redo()
+    assert worksheet.get_cell_value(0, 1) == 20.0
+    assert worksheet.get_cell_text(1, 0) == "3"
+
+
+def test_undo_without_recalculating_leaves_it_to_a_job():
+    workbook = Workbook()
+    workbook.add_sheet("S")
+    worksheet = workbook.get_sheet("S")
+    worksheet.set_range(0, 0, [[1, "=A1 * 10"], [2, "=A2 * 10"]])
+    worksheet.set_range(0, 0, [[3], [4]])
+
+    written = workbook.undo(recalculate=False)
+    assert {cell.get_name() for cell in written} == {"A1", "A2"}
+    assert worksheet.get_cell_text(0, 0) == "1"
+    assert worksheet.get_cell_value(0, 1) == 30.0
+    job = RecalcJob(workbook.engine, written)
+    job.run()
+    assert worksheet.get_cell_value(0, 1) == 10.0
+    assert worksheet.get_cell_value(1, 1) == 20.0
+
+    RecalcJob(workbook.engine, workbook.redo(recalculate=False)).run()
+    assert worksheet.get_cell_value(1, 1) == 40.0
+
+
+def test_undo_history_is_bounded_in_cells():
+    workbook = Workbook()
+    workbook.add_sheet("S")
+    worksheet = workbook.get_sheet("S")
+    journal = workbook.journal
+    journal.max_cells = 10
+    for value in range(8):
+        worksheet.set_range(0, 0, [[value, value]])
+    assert journal.cells == 10
+    assert len(journal.undo_stack) == 5
+
+    worksheet.set_range(5, 0, [[1] * 4], undoable=False)
+    assert journal.cells == 0 and not journal.undo_stack
+
+
+def test_undo_checkpoints_keep_the_first_old_text():
+    workbook = Workbook()
+    workbook.add_sheet("S")
+    worksheet = workbook.get_sheet("S")
+    workbook.journal.limit = 2
+    worksheet.set_range(1, 0, [[1], [2]])
+    worksheet.set_range(2, 0, [[5], [6]])
+    worksheet.set_range(0, 0, [[7]])
+    assert len(workbook.journal.undo_stack) == 2
+    workbook.undo()
+    assert [worksheet.get_cell_text(row, 0) for row in range(4)] == [None, "1", "5", "6"]
+    workbook.undo()
+    assert [worksheet.get_cell_text(row, 0) for row in range(4)] == [None, None, None, None]
+
+
+def journal_bytes(changes) -> int:
+    """The memory a journal holds after recording the (row, old, new) changes of column A as one operation."""
+    worksheet = sheet()
+    journal = Journal(RecalcEngine())
+    tracemalloc.start()
+    before, _ = tracemalloc.get_traced_memory()
+    for row, old_text, new_text in changes:
+        journal.record(worksheet, row, 0, old_text, new_text)
+    journal.close()
+    after, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    assert journal.cells == len(changes)
+    return after - before
+
+
+def test_undo_history_memory_is_compact():
+    # scattered single cells cost a few hundred bytes, not a chunk of rows (8 KiB) each
+    scattered = [(row * CHUNK_SIZE, None, str(row)) for row in range(5000)]
+    assert journal_bytes(scattered) < 5000 * 1024
+    # a block of numbers costs about 16 bytes per row
+    block = [(row, str(row), str(row + 1)) for row in range(100_000)]
+    assert journal_bytes(block) < 100_000 * 24
+
+
+def test_approximate_match_in_part_of_a_large_column():
+    rows = CHUNK_SIZE * 4
+    worksheet = sheet(rows=rows, columns=4)
+    worksheet.set_range(0, 0, [[row % 100] for row in range(rows)])
+    # most keys of the column are in the searched order but outside the rows of the range
+    worksheet.set_range(0, 1, [["=MATCH(200, A2001:A2010, 1)", "=MATCH(5, A2001:A2010, -1)",
+                                '=COUNTIF(A2001:A2010, ">=5")']])
+    assert [worksheet.get_cell_value(0, column) for column in (1, 2, 3)] == [10, 6, 5]
+    worksheet.set_cell_value(2001, 0, 150)
+    worksheet.set_cell_value(2005, 0, "text")
+    assert [worksheet.get_cell_value(0, column) for column in (1, 2, 3)] == [2, 7, 5]
+
+
+@pytest.mark.parametrize("name, row, column", [("A1", 0, 0), ("Z9", 8, 25), ("AA1", 0, 26), ("ZZ10", 9, 701),
+                                               ("AAA3", 2, 702), ("ab12", 11, 27)])
+def test_cell_names_round_trip(name, row, column):
+    assert parse_cell_name(name) == (row, column)
+    assert f"{column_index_to_letter(column)}{row + 1}" == name.upper()
+
+
+@pytest.mark.parametrize("name", ["", "A", "12", "1A", "A1B", "Ä1"])
+def test_invalid_cell_names_raise_value_error(name):
+    with pytest.raises(ValueError):
+        parse_cell_name(name)
+
+
+def test_lookups_and_counts_follow_edits():
+    worksheet = sheet(rows=10, columns=8)
+    worksheet.set_range(0, 0, [["apple", 1], ["Banana", 2], ["cherry", 3], [10, 4], [20, 5]])
+    worksheet.set_range(0, 3, [['=VLOOKUP("banana", A1:B5, 2, 0)', "=VLOOKUP(15, A1:B5, 2)",
+                                '=MATCH("CHERRY", A1:A5, 0)', "=MATCH(8, A1:B1, 1)",
+                                '=COUNTIF(A1:B5, ">2")']])
+    assert [worksheet.get_cell_value(0, column) for column in range(3, 8)] == [2, 4, 3, 2, 5]
+
+    # the column index is kept up to date by every write
+    worksheet.get_cell(0, 0).insert_text("cherry")
+    worksheet.get_cell(2, 0).insert_text("banana")
+    worksheet.get_cell(1, 0).insert_text("date")
+    worksheet.get_cell(3, 0).insert_text("12")
+    worksheet.get_cell(4, 0).insert_text("14")
+    worksheet.get_cell(0, 1).insert_text("7")
+    assert [worksheet.get_cell_value(0, column) for column in range(3, 8)] == [3, 5, 1, 2, 6]
+
+
+def test_profile_counts_evaluations_depth_and_the_slowest_chain():
+    workbook = Workbook()
+    workbook.add_sheet("S")
+    worksheet = workbook.get_sheet("S")
+    profile = workbook.start_profiling()
+    worksheet.set_range(0, 0, [[1, "=A1 + 1", "=B1 * 2"]])
+    worksheet.set_cell_value(0, 0, 5)
+    assert workbook.stop_profiling() is profile
+    worksheet.set_cell_value(0, 0, 6)
+
+    data = profile.to_json()
+    assert (data["recalculations"], data["compilations"]) == (2, 2)
+    assert data["evaluations"] == 4
+    assert {entry["cell"]: (entry["evaluations"], entry["depth"]) for entry in data["cells"]} == {
+        "S!B1": (2, 1), "S!C1": (2, 2)}
+    # one chain per recalculation, the edit of A1 starts the second one
+    assert sorted(chain["cells"] for chain in data["slowest_chains"]) == [["S!A1", "S!B1", "S!C1"], ["S!B1", "S!C1"]]
+    assert "S!C1" in profile.report()
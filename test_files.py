@@ -0,0 +1,156 @@
+"""Tests of saving and loading workbooks, and of the parallel paths."""
+
+# Import packages
+import csv
+import json
+import pytest
+import cli
+from classes import Workbook, save_workbook_as, save_workbook_binary
+
+
+def sample_workbook() -> Workbook:
+    """Two sheets referencing each other, with text, ranges and a broken formula."""
+    workbook = Workbook()
+    for sheet_name in ("Data", "Report", "Other"):
+        workbook.add_sheet(sheet_name)
+    data = workbook.get_sheet("Data")
+    data.set_range(0, 0, [[row, f"=A{row + 1} * 2", "text" if row % 3 else None] for row in range(50)])
+    data.set_range(60, 0, [[0.1], [-3.5], [1e20]])
+    report = workbook.get_sheet("Report")
+    report.set_range(0, 0, [["=SUM(Data!A1:A50)", "=Data!B2 + 1", "=COUNT(Data!A1:C50)", "hello"]])
+    with pytest.raises(ValueError):
+        report.set_range(1, 0, [["=1+"], ["=Later!A1 + 1"]])
+    workbook.get_sheet("Other").set_range(0, 0, [[row, f"=A{row + 1} + 1"] for row in range(20)])
+    return workbook
+
+
+def contents(workbook: Workbook) -> dict:
+    """The text and value of every cell, by sheet."""
+    return {sheet_name: {(row, column): (worksheet.get_cell_text(row, column), worksheet.get_cell_value(row, column))
+                         for row, cells in worksheet.iter_sparse_rows() for column, *_ in cells}
+            for sheet_name, worksheet in workbook.sheets.items()}
+
+
+def reloaded(filename) -> Workbook:
+    workbook = Workbook()
+    workbook.load_from_file(str(filename))
+    return workbook
+
+
+def test_sparse_json_round_trip(tmp_path):
+    workbook = sample_workbook()
+    save_workbook_as(workbook, str(tmp_path / "book.json"))
+    assert contents(reloaded(tmp_path / "book.json")) == contents(workbook)
+
+
+def test_dense_json_round_trip(tmp_path):
+    workbook = sample_workbook()
+    with open(tmp_path / "book.json", 'w') as file:
+        json.dump(workbook.to_json(), file, indent=2)
+    assert contents(reloaded(tmp_path / "book.json")) == contents(workbook)
+
+
+def test_binary_round_trip(tmp_path):
+    workbook = sample_workbook()
+    save_workbook_binary(workbook, str(tmp_path / "book.xlcol"))
+    assert contents(reloaded(tmp_path / "book.xlcol")) == contents(workbook)
+
+
+def test_binary_save_over_the_file_it_was_opened_from(tmp_path):
+    filename = tmp_path / "book.xlcol"
+    save_workbook_binary(sample_workbook(), str(filename))
+    workbook = reloaded(filename)
+    # only Data is loaded, the other sheets and most numbers are still mapped
+    workbook.get_sheet("Data").set_cell_value(0, 0, 100)
+    expected = contents(workbook)
+    save_workbook_binary(workbook, str(filename))
+    assert contents(reloaded(filename)) == expected
+    assert [path.name for path in tmp_path.iterdir()] == ["book.xlcol"]
+
+
+@pytest.mark.parametrize("name", ["book.json", "book.xlcol"])
+def test_formulas_waiting_for_a_sheet_are_linked_after_loading(tmp_path, name):
+    filename = tmp_path / name
+    (save_workbook_binary if name.endswith(".xlcol") else save_workbook_as)(sample_workbook(), str(filename))
+    workbook = reloaded(filename)
+    report = workbook.get_sheet("Report")
+    assert report.get_cell_value(2, 0) is None
+    workbook.add_sheet("Later")
+    workbook.get_sheet("Later").set_cell_value(0, 0, 41)
+    assert report.get_cell_value(2, 0) == 42.0
+    assert report.get_cell_text(1, 0) == "=1+"
+
+
+def test_parallel_recalculation_matches_serial():
+    serial, parallel = sample_workbook(), sample_workbook()
+    serial.get_sheet("Data").set_cell_value(0, 0, 7)
+    parallel.get_sheet("Data").set_cell_value(0, 0, 7)
+    serial.recalculate()
+    parallel.recalculate(workers=2)
+    assert contents(parallel) == contents(serial)
+
+
+def test_parallel_load_and_save_match_serial(tmp_path):
+    workbook = sample_workbook()
+    assert workbook.to_json(workers=2) == workbook.to_json()
+
+    save_workbook_as(workbook, str(tmp_path / "serial.json"))
+    save_workbook_as(workbook, str(tmp_path / "parallel.json"), workers=2)
+    assert (tmp_path / "serial.json").read_bytes() == (tmp_path / "parallel.json").read_bytes()
+
+    loaded = Workbook()
+    loaded.load_from_file(str(tmp_path / "parallel.json"), workers=2)
+    assert contents(loaded) == contents(workbook)
+
+    loaded = Workbook()
+    loaded.load_from_json(workbook.to_json(), workers=2)
+    assert contents(loaded) == contents(workbook)
+
+
+@pytest.mark.parametrize("name", ["book.json", "book.xlcol"])
+def test_loading_a_sheet_links_waiting_formulas_and_replaces_the_old_sheet(tmp_path, name):
+    source = Workbook()
+    source.add_sheet("Data")
+    source.get_sheet("Data").set_cell_value(0, 0, 1)
+    filename = tmp_path / name
+    (save_workbook_binary if name.endswith(".xlcol") else save_workbook_as)(source, str(filename))
+
+    workbook = Workbook()
+    workbook.add_sheet("Main")
+    main = workbook.get_sheet("Main")
+    with pytest.raises(ValueError):
+        main.set_cell_value(0, 0, "=Data!A1 + 1")
+    workbook.load_from_file(str(filename))
+    assert main.get_cell_value(0, 0) == 2.0
+    old_data = workbook.get_sheet("Data")
+
+    # loading again replaces Data, Main follows the new sheet
+    workbook.load_from_file(str(filename))
+    assert workbook.get_sheet("Data") is not old_data
+    workbook.get_sheet("Data").set_cell_value(0, 0, 100)
+    assert main.get_cell_value(0, 0) == 101.0
+    assert not old_data.dependent_cells()
+
+
+def test_command_line_writes_the_values_of_every_sheet_as_csv(tmp_path, capsys):
+    save_workbook_as(sample_workbook(), str(tmp_path / "book.json"))
+    assert cli.main([str(tmp_path / "book.json"), "-o", str(tmp_path / "out")]) == 0
+    assert sorted(path.name for path in (tmp_path / "out").iterdir()) == [
+        "book-Data.csv", "book-Other.csv", "book-Report.csv"]
+    with open(tmp_path / "out" / "book-Report.csv", newline='') as file:
+        rows = list(csv.reader(file))
+    assert rows[:3] == [["1225", "3", "100", "hello"], ["", "", "", ""], ["", "", "", ""]]
+
+    capsys.readouterr()
+    assert cli.main([str(tmp_path / "book.json"), "--sheet", "Data", "--stdout"]) == 0
+    assert capsys.readouterr().out.splitlines()[:2] == ["0,0,", "1,2,text"]
+
+
+def test_command_line_refuses_files_writing_the_same_output(tmp_path):
+    for directory in ("a", "b"):
+        (tmp_path / directory).mkdir()
+        save_workbook_as(sample_workbook(), str(tmp_path / directory / "book.json"))
+    with pytest.raises(SystemExit) as error:
+        cli.main([str(tmp_path / "a" / "book.json"), str(tmp_path / "b" / "book.json"), "-o", str(tmp_path / "out")])
+    assert error.value.code == 2
+    assert not (tmp_path / "out").exists()
@@ -0,0 +1,93 @@
+"""Tests of the formula tokenizer, parser and compiler."""
+
+# Import packages
+import math
+import pytest
+from formulas import FUNCTIONS, compile_formula, function_cache_info, register_function, split_reference
+
+
+def evaluate(text, values=()):
+    return compile_formula(text).evaluate(list(values))
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("=1+2*3", 7.0),
+    ("=(1+2)*3", 9.0),
+    ("=2**3**2", 512.0),
+    ("=-2**2", -4.0),
+    ("=7//2", 3.0),
+    ("=7%3", 1.0),
+    ("=.5e1", 5.0),
+    ("=1+2<4", True),
+    ("=2<>2", False),
+    ("=TRUE+false", 1.0),
+    ('="a""b"', 'a"b'),
+    ('="x"=="x"', True),
+    ("=sum(1, 2, 3)", 6.0),
+    ("=abs(-3) + sqrt(16)", 7.0),
+    ("=max()", 0.0),
+])
+def test_constant_expressions(text, expected):
+    assert evaluate(text) == expected
+
+
+def test_references_are_upper_cased_and_listed_once_in_order():
+    formula = compile_formula("=b2 + A1 * B2 + SUM(a1:b3, A1)")
+    assert formula.references == ("B2", "A1", "A1:B3")
+    assert formula.expression == "b2 + A1 * B2 + SUM(a1:b3, A1)"
+
+
+def test_sheet_references():
+    formula = compile_formula("='My ''big'' sheet'!a1 + Sheet2!B2 + SUM(Sheet2!A1:A3)")
+    assert formula.references == ("My 'big' sheet!A1", "Sheet2!B2", "Sheet2!A1:A3")
+    assert split_reference(formula.references[0]) == ("My 'big' sheet", "A1")
+    assert split_reference("A1:B5") == ("", "A1:B5")
+
+
+def test_empty_cells_read_as_zero():
+    assert evaluate("=A1 + 1", [None]) == 1
+
+
+@pytest.mark.parametrize("text", [
+    "x", "=", "=1+", "=(1", "=1)", "=1 2", "=foo(1)", "=bar", "=A1:B2", "=Sheet2!A1:B2",
+    "=SUM(A1:)", "=1$", "=Sheet2!", '="abc',
+])
+def test_invalid_formulas_raise_value_error(text):
+    with pytest.raises(ValueError):
+        compile_formula(text)
+
+
+@pytest.mark.parametrize("text", ['="a"+1', '=1<"a"', '=-"a"', "=1/0", "=sqrt(-1)"])
+def test_constant_errors_are_left_to_evaluation(text):
+    formula = compile_formula(text)
+    with pytest.raises((ArithmeticError, TypeError, ValueError)):
+        formula.evaluate([])
+
+
+def test_deep_nesting_raises_value_error():
+    with pytest.raises(ValueError):
+        compile_formula("=" + "(" * 5000 + "1" + ")" * 5000)
+
+
+def test_aggregates_skip_empty_and_text_cells():
+    assert evaluate("=COUNT(A1, A2, 3)", [None, "text"]) == 1
+    assert evaluate("=SUM(A1, A2, 3)", [None, "text"]) == 3
+    assert evaluate("=AVERAGE(A1, A2, 4)", [None, 2.0]) == 3
+    # an expression of the cell is a number
+    assert evaluate("=COUNT(A1 * 1)", [None]) == 1
+    assert math.isclose(evaluate("=MIN(A1, 0.5)", [None]), 0.5)
+
+
+def test_memoized_function_cache_hits_misses_and_eviction():
+    calls = []
+    register_function("twice", lambda value: calls.append(value) or value * 2, memoize=True, cache_size=2)
+    try:
+        formula = compile_formula("=TWICE(A1)")
+        for value in (1.0, 2.0, 1.0, 3.0, 2.0):
+            assert formula.evaluate([value]) == value * 2
+        # 3.0 evicts 2.0, the least recently used value at the time
+        assert calls == [1.0, 2.0, 3.0, 2.0]
+        info = function_cache_info()["twice"]
+        assert (info.hits, info.misses, info.maxsize, info.currsize) == (1, 4, 2, 2)
+    finally:
+        del FUNCTIONS["twice"]